@@ -0,0 +1,154 @@
+import glob
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+# Tables that get a row on every click or login, with the column that dates a
+# row. Sessions go last since views and searches reference them.
+ARCHIVE_TABLES = {
+    "viewedProduct": ("ts", "cid, sessionNo, ts, pid"),
+    "search": ("ts", "cid, sessionNo, ts, query"),
+    "sessions": ("start_time", "cid, sessionNo, start_time, end_time"),
+}
+
+# Archive databases have the same tables and keys, without foreign keys
+ARCHIVE_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS archive.viewedProduct(
+    cid TEXT,
+    sessionNo INTEGER,
+    ts DATETIME,
+    pid TEXT,
+    PRIMARY KEY (cid, sessionNo, ts, pid)
+);
+CREATE TABLE IF NOT EXISTS archive.search(
+    cid TEXT,
+    sessionNo INTEGER,
+    ts DATETIME,
+    query TEXT,
+    PRIMARY KEY (cid, sessionNo, ts)
+);
+CREATE TABLE IF NOT EXISTS archive.sessions(
+    cid TEXT,
+    sessionNo INTEGER,
+    start_time DATETIME NOT NULL,
+    end_time DATETIME,
+    PRIMARY KEY (cid, sessionNo)
+);
+"""
+
+# Rows to move (rowid and month). A customer's latest session stays, as do
+# sessions that still have a cart or views/searches in the hot tables.
+CANDIDATES_SQL = {
+    "viewedProduct": """
+        SELECT rowid AS rid, substr(ts, 1, 7) AS month, pid
+        FROM main.viewedProduct WHERE ts < ?
+    """,
+    "search": """
+        SELECT rowid AS rid, substr(ts, 1, 7) AS month
+        FROM main.search WHERE ts < ?
+    """,
+    "sessions": """
+        SELECT s.rowid AS rid, substr(s.start_time, 1, 7) AS month
+        FROM main.sessions s
+        WHERE s.start_time < ?
+          AND s.sessionNo < (SELECT MAX(m.sessionNo) FROM main.sessions m WHERE m.cid = s.cid)
+          AND NOT EXISTS (SELECT 1 FROM main.cart c
+                          WHERE c.cid = s.cid AND c.sessionNo = s.sessionNo)
+          AND NOT EXISTS (SELECT 1 FROM main.viewedProduct v
+                          WHERE v.cid = s.cid AND v.sessionNo = s.sessionNo)
+          AND NOT EXISTS (SELECT 1 FROM main.search q
+                          WHERE q.cid = s.cid AND q.sessionNo = s.sessionNo)
+    """,
+}
+
+SUMMARIZE_VIEWS_SQL = """
+    INSERT INTO main.view_counts_archived (pid, month, views)
+    SELECT pid, month, COUNT(*) FROM temp.archiving
+    WHERE month = ?
+    GROUP BY pid
+    ON CONFLICT (pid, month) DO UPDATE SET views = views + excluded.views
+"""
+
+
+def archive_path(db_name, month, archive_dir=None):
+    """<db name>-archive-YYYY-MM.db next to the database (or in archive_dir)"""
+    stem = os.path.splitext(os.path.basename(db_name))[0]
+    return os.path.join(archive_dir or os.path.dirname(os.path.abspath(db_name)),
+                        f"{stem}-archive-{month}.db")
+
+
+def archive_files(db_name, archive_dir=None):
+    """[(month, path)] of the existing archives, oldest first"""
+    pattern = archive_path(db_name, "[0-9][0-9][0-9][0-9]-[0-9][0-9]", archive_dir)
+    return [(path[-10:-3], path) for path in sorted(glob.glob(pattern))]
+
+
+@contextmanager
+def attached(conn, path):
+    """The database at path attached as "archive" (outside any transaction)"""
+    conn.execute("ATTACH DATABASE ? AS archive", (path,))
+    try:
+        yield
+    finally:
+        conn.execute("DETACH DATABASE archive")
+
+
+def archive(conn, db_name, retention_days=90, archive_dir=None, commit=None, today=None):
+    """Move viewedProduct, search and sessions rows older than retention_days
+    into per-month archive databases, returns {table: rows moved}
+
+    Each month of each table moves in one transaction spanning both files, and
+    the moved views are added to view_counts_archived in the same transaction.
+    (With WAL journaling SQLite commits attached files separately, so a crash
+    mid-commit can leave a month in both places; rerunning is safe, the archive
+    ignores rows it already has.)
+    """
+    commit = commit or conn.commit
+    cutoff = ((today or datetime.now()) - timedelta(days=retention_days)).strftime("%Y-%m-%d %H:%M:%S")
+    commit()  # ATTACH can't run inside a transaction
+    moved = {}
+    for table, (_, columns) in ARCHIVE_TABLES.items():
+        moved[table] = 0
+        conn.execute("DROP TABLE IF EXISTS temp.archiving")
+        conn.execute(f"CREATE TEMP TABLE archiving AS {CANDIDATES_SQL[table]}", (cutoff,))
+        conn.execute("CREATE INDEX temp.archiving_month ON archiving (month, rid)")
+        months = [row[0] for row in conn.execute("SELECT DISTINCT month FROM temp.archiving ORDER BY month")]
+        rows = "rowid IN (SELECT rid FROM temp.archiving WHERE month = ?)"
+        for month in months:
+            with attached(conn, archive_path(db_name, month, archive_dir)):
+                conn.executescript(ARCHIVE_SCHEMA_SQL)
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.execute(f"""
+                        INSERT OR IGNORE INTO archive.{table} ({columns})
+                        SELECT {columns} FROM main.{table} WHERE {rows}
+                    """, (month,))
+                    if table == "viewedProduct":
+                        conn.execute(SUMMARIZE_VIEWS_SQL, (month,))
+                    moved[table] += conn.execute(f"DELETE FROM main.{table} WHERE {rows}", (month,)).rowcount
+                    commit()
+                except sqlite3.Error:
+                    conn.rollback()
+                    raise
+        conn.execute("DROP TABLE temp.archiving")
+    return moved
+
+
+def archived_rows(conn, db_name, table, archive_dir=None, months=None, batch_size=1000,
+                  condition=None, params=()):
+    """Yield the archived rows of one table, month by month (oldest first);
+    months limits it to those "YYYY-MM" months, condition (an SQL expression
+    on the table's columns, with params) to matching rows"""
+    columns = ARCHIVE_TABLES[table][1]
+    where = f" WHERE {condition}" if condition else ""
+    for month, path in archive_files(db_name, archive_dir):
+        if months is not None and month not in months:
+            continue
+        with attached(conn, path):
+            cursor = conn.execute(f"SELECT {columns} FROM archive.{table}{where}", params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
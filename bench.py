@@ -0,0 +1,427 @@
+"""Load generator and benchmark for ECommerceService
+
+Generate a synthetic database (schema from prj-tables.sql):
+    python bench.py generate bench.db --products 1000000 --customers 100000 --orders 500000
+
+Drive it with a mix of operations and write latency percentiles as JSON:
+    python bench.py run bench.db --ops 5000 --output run.json
+
+Compare against an earlier run (exit status 1 on a regression):
+    python bench.py run bench.db --ops 5000 --output new.json --compare run.json
+
+Login (password verification) throughput per core for each hashing setting:
+    python bench.py login --settings pbkdf2_sha256:300000,pbkdf2_sha256:600000,scrypt:14
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from service import ECommerceService, ServiceError, Session
+from connection import load_profile
+from passwords import PasswordHasher
+
+TABLES_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prj-tables.sql")
+BATCH = 10000
+
+WORDS = ("laptop wireless mouse keyboard monitor usb hub adapter bag headphones webcam ssd "
+         "drive cable charger phone tablet case stand speaker camera printer router desk "
+         "lamp chair ergonomic gaming premium portable compact ultra pro mini max smart "
+         "digital bluetooth mechanical rgb hd 4k noise canceling fast external").split()
+CATEGORIES = ("Electronics", "Accessories", "Office", "Audio", "Storage", "Networking")
+
+DEFAULT_MIX = "search=40,view=25,cart=15,checkout=4,orders=10,report=3,top=3"
+DEFAULT_LOGIN_SETTINGS = "pbkdf2_sha256:100000,pbkdf2_sha256:300000,pbkdf2_sha256:600000,scrypt:14,scrypt:15"
+
+
+# --- data generation ---
+
+def batched(rows, size=BATCH):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def load(conn, sql, rows):
+    for chunk in batched(rows):
+        conn.executemany(sql, chunk)
+    conn.commit()
+
+
+def generate(db_name, products, customers, sessions, orders, views, searches, seed=0):
+    """Create a synthetic database of the given size; deterministic for a given seed"""
+    rng = random.Random(seed)
+    if os.path.exists(db_name):
+        os.remove(db_name)
+    conn = sqlite3.connect(db_name)
+    with open(TABLES_SQL) as f:
+        conn.executescript(f.read())
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    today = datetime.now()
+    #one hash shared by every synthetic user keeps generation fast
+    hasher = PasswordHasher()
+    pwd = hasher.hash("password123")
+    hasher.close()
+
+    def day(max_age):
+        return (today - timedelta(days=rng.randrange(max_age))).strftime("%Y-%m-%d")
+
+    def stamp(max_age):
+        return (today - timedelta(seconds=rng.randrange(max_age * 86400))).strftime("%Y-%m-%d %H:%M:%S")
+
+    load(conn, "INSERT INTO users VALUES (?, ?, ?)",
+         ((str(i), pwd, "customer") for i in range(1, customers + 1)))
+    conn.execute("INSERT INTO users VALUES (?, ?, 'sales')", (str(customers + 1), pwd))
+    load(conn, "INSERT INTO customers VALUES (?, ?, ?)",
+         ((str(i), f"Customer {i}", f"customer{i}@example.com") for i in range(1, customers + 1)))
+    load(conn, "INSERT INTO products VALUES (?, ?, ?, ?, ?, ?)",
+         ((f"P{i:07d}", " ".join(rng.sample(WORDS, 3)).title(), rng.choice(CATEGORIES),
+           round(rng.uniform(5, 2000), 2), rng.randrange(100, 10000),
+           " ".join(rng.choices(WORDS, k=12)))
+          for i in range(1, products + 1)))
+    #sessions are numbered per customer round robin: session s belongs to customer s % customers
+    session_keys = [(str(s % customers + 1), s // customers + 1) for s in range(sessions)]
+    load(conn, "INSERT INTO sessions VALUES (?, ?, ?, ?)",
+         ((cid, sno, stamp(365), None) for cid, sno in session_keys))
+
+    def pid():
+        return f"P{rng.randrange(1, products + 1):07d}"
+
+    def order_rows():
+        for ono in range(1, orders + 1):
+            cid, sno = rng.choice(session_keys)
+            yield ono, cid, sno, day(365), f"{rng.randrange(1, 9999)} Main St"
+
+    def line_rows():
+        for ono in range(1, orders + 1):
+            for line_no, p in enumerate(set(pid() for _ in range(rng.randrange(1, 6))), start=1):
+                yield ono, line_no, p, rng.randrange(1, 4), round(rng.uniform(5, 2000), 2)
+
+    load(conn, "INSERT INTO orders VALUES (?, ?, ?, ?, ?)", order_rows())
+    load(conn, "INSERT INTO orderlines VALUES (?, ?, ?, ?, ?)", line_rows())
+    load(conn, "INSERT OR IGNORE INTO viewedProduct VALUES (?, ?, ?, ?)",
+         (rng.choice(session_keys) + (stamp(365), pid()) for _ in range(views)))
+    load(conn, "INSERT OR IGNORE INTO search VALUES (?, ?, ?, ?)",
+         (rng.choice(session_keys) + (stamp(365), " ".join(rng.sample(WORDS, rng.randrange(1, 3))))
+          for _ in range(searches)))
+    conn.close()
+    #indexes, search index and rollups are built by the migrations
+    service = ECommerceService(db_name)
+    service.connect()
+    service.close()
+
+
+# --- workload ---
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, weight = part.split("=")
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation: {name}")
+        mix[name] = float(weight)
+    return mix
+
+
+class Workload:
+    """One simulated client: a customer session plus a sales session"""
+    def __init__(self, service, rng):
+        self.service = service
+        self.rng = rng
+        cursor = service.conn.execute("SELECT MIN(rowid), MAX(rowid) FROM products")
+        self.rowids = cursor.fetchone()
+        self.customers = service.conn.execute("SELECT COUNT(*) FROM customers").fetchone()[0]
+        cid = str(rng.randrange(1, self.customers + 1))
+        self.customer = Session(cid, "customer", service.start_session(cid))
+        self.sales = Session("bench", "sales")
+
+    def random_pid(self):
+        low, high = self.rowids
+        row = self.service.conn.execute(
+            "SELECT pid FROM products WHERE rowid >= ? LIMIT 1",
+            (self.rng.randrange(low, high + 1),)).fetchone()
+        return row[0]
+
+    def search(self):
+        query = " ".join(self.rng.sample(WORDS, self.rng.choice((1, 1, 2))))
+        page = self.service.search(self.customer, query)
+        if page.rows and self.rng.random() < 0.3:
+            last = page.rows[-1]
+            self.service.search(self.customer, query, (last[1], last[0]))
+
+    def view(self):
+        self.service.product(self.customer, self.random_pid())
+
+    def cart(self):
+        self.service.add_to_cart(self.customer, self.random_pid())
+        self.service.cart(self.customer)
+
+    def checkout(self):
+        if not self.service.cart(self.customer).items:
+            self.service.add_to_cart(self.customer, self.random_pid())
+        self.service.checkout(self.customer, "1 Bench St")
+
+    def orders(self):
+        page = self.service.orders(self.customer)
+        if page.rows:
+            self.service.order_detail(self.customer, page.rows[0][0])
+
+    def report(self):
+        self.service.sales_report(self.sales, self.rng.choice((7, 7, 30, 90)))
+
+    def top(self):
+        self.service.top_products(self.sales)
+
+
+OPERATIONS = {
+    "search": Workload.search,
+    "view": Workload.view,
+    "cart": Workload.cart,
+    "checkout": Workload.checkout,
+    "orders": Workload.orders,
+    "report": Workload.report,
+    "top": Workload.top,
+}
+
+
+def drive(args):
+    """Run ops operations in one process, returns ({op: [latency seconds]}, {op: errors},
+    statement cache stats)"""
+    db_name, ops, mix, seed, settings = args
+    rng = random.Random(seed)
+    service = ECommerceService(db_name, connection_settings=settings)
+    service.connect()
+    workload = Workload(service, rng)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    for name in rng.choices(names, weights, k=ops):
+        start = time.perf_counter()
+        try:
+            OPERATIONS[name](workload)
+        except (ServiceError, sqlite3.Error):
+            errors[name] += 1
+        latencies[name].append(time.perf_counter() - start)
+    service.close()
+    return latencies, errors, service.queries.stats()
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(latencies, errors, wall):
+    operations = {}
+    for name, values in latencies.items():
+        values = sorted(values)
+        operations[name] = {
+            "count": len(values),
+            "errors": errors[name],
+            "mean_ms": 1000 * sum(values) / len(values) if values else 0.0,
+            "p50_ms": 1000 * percentile(values, 50),
+            "p95_ms": 1000 * percentile(values, 95),
+            "p99_ms": 1000 * percentile(values, 99),
+            "throughput_ops_s": len(values) / wall if wall else 0.0,
+        }
+    total = sum(op["count"] for op in operations.values())
+    return {"operations": operations,
+            "total": {"count": total, "wall_s": wall, "throughput_ops_s": total / wall if wall else 0.0}}
+
+
+def run(db_name, ops, mix, workers=1, seed=0, settings=None):
+    settings = settings or load_profile("concurrent" if workers > 1 else "default")
+    jobs = [(db_name, ops // workers + (i < ops % workers), mix, seed + i, settings)
+            for i in range(workers)]
+    start = time.perf_counter()
+    if workers == 1:
+        results = [drive(jobs[0])]
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(drive, jobs)
+    wall = time.perf_counter() - start
+    latencies = {name: [] for name in mix}
+    errors = {name: 0 for name in mix}
+    hits = misses = 0
+    for worker_latencies, worker_errors, stats in results:
+        for name in mix:
+            latencies[name].extend(worker_latencies[name])
+            errors[name] += worker_errors[name]
+        hits += stats["hits"]
+        misses += stats["misses"]
+    result = summarize(latencies, errors, wall)
+    result["statement_cache"] = {"hits": hits, "misses": misses,
+                                 "hit_rate": hits / (hits + misses) if hits + misses else 0.0}
+    result["meta"] = {
+        "database": os.path.basename(db_name),
+        "ops": ops,
+        "workers": workers,
+        "seed": seed,
+        "mix": mix,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "time": datetime.now().isoformat(timespec="seconds"),
+    }
+    return result
+
+
+def compare(current, baseline, threshold=0.2, metric="p95_ms"):
+    """Operations whose metric got more than threshold (fraction) slower, as
+    {op: (baseline, current, ratio)}"""
+    regressions = {}
+    for name, op in current["operations"].items():
+        before = baseline["operations"].get(name)
+        if not before or not before[metric]:
+            continue
+        ratio = op[metric] / before[metric]
+        if ratio > 1 + threshold:
+            regressions[name] = (before[metric], op[metric], ratio)
+    return regressions
+
+
+def print_summary(result, baseline=None, metric="p95_ms"):
+    print(f"{'Operation':<10} {'Count':>7} {'Err':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/s':>9}"
+          + (f" {'vs base':>8}" if baseline else ""))
+    print("-" * (64 + (9 if baseline else 0)))
+    for name, op in result["operations"].items():
+        line = (f"{name:<10} {op['count']:>7} {op['errors']:>5} {op['p50_ms']:>9.2f} "
+                f"{op['p95_ms']:>9.2f} {op['p99_ms']:>9.2f} {op['throughput_ops_s']:>9.1f}")
+        before = baseline["operations"].get(name) if baseline else None
+        if before and before[metric]:
+            line += f" {op[metric] / before[metric]:>7.2f}x"
+        print(line)
+    total = result["total"]
+    print(f"\n{total['count']} operations in {total['wall_s']:.2f}s ({total['throughput_ops_s']:.1f} ops/s)")
+    if "statement_cache" in result:
+        print(f"Statement cache hit rate {result['statement_cache']['hit_rate']:.1%}")
+
+
+# --- login throughput ---
+
+def login_throughput(scheme, cost, threads, seconds=2.0):
+    """Verified logins per second for one hashing setting, single threaded and
+    with threads concurrent verifications"""
+    hasher = PasswordHasher(scheme, cost, workers=1)
+    encoded = hasher.hash("password123")
+    hasher.close()
+
+    def verify_for(deadline):
+        count = 0
+        while time.perf_counter() < deadline:
+            hasher.check("password123", encoded)
+            count += 1
+        return count
+
+    rates = {}
+    for n in (1, threads):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(n) as pool:
+            counts = list(pool.map(verify_for, [start + seconds] * n))
+        rates[n] = sum(counts) / (time.perf_counter() - start)
+    return {
+        "scheme": scheme,
+        "cost": cost,
+        "single_thread_per_s": rates[1],
+        "threads": threads,
+        "all_threads_per_s": rates[threads],
+        "per_core_per_s": rates[threads] / threads,
+        "verify_ms": 1000 / rates[1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="E-commerce benchmark")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    gen = sub.add_parser("generate", help="create a synthetic database")
+    gen.add_argument("database_file")
+    gen.add_argument("--products", type=int, default=100000)
+    gen.add_argument("--customers", type=int, default=10000)
+    gen.add_argument("--sessions", type=int, default=None, help="default: 3 per customer")
+    gen.add_argument("--orders", type=int, default=50000)
+    gen.add_argument("--views", type=int, default=500000)
+    gen.add_argument("--searches", type=int, default=200000)
+    gen.add_argument("--seed", type=int, default=0)
+
+    bench = sub.add_parser("run", help="run a workload and report latencies")
+    bench.add_argument("database_file")
+    bench.add_argument("--ops", type=int, default=2000)
+    bench.add_argument("--mix", default=DEFAULT_MIX, help=f"op=weight,... (default {DEFAULT_MIX})")
+    bench.add_argument("--workers", type=int, default=1, help="client processes")
+    bench.add_argument("--seed", type=int, default=0)
+    bench.add_argument("--output", help="write results as JSON to this file")
+    bench.add_argument("--compare", help="earlier results JSON to compare against")
+    bench.add_argument("--threshold", type=float, default=0.2,
+                       help="allowed slowdown before a regression is reported (default 0.2 = 20%%)")
+    bench.add_argument("--metric", default="p95_ms", choices=("p50_ms", "p95_ms", "p99_ms", "mean_ms"))
+    login = sub.add_parser("login", help="password verification throughput per hashing setting")
+    login.add_argument("--settings", default=DEFAULT_LOGIN_SETTINGS,
+                       help="scheme:cost,... (pbkdf2 iterations, scrypt log2 n)")
+    login.add_argument("--threads", type=int, default=os.cpu_count() or 1)
+    login.add_argument("--seconds", type=float, default=2.0, help="per setting and thread count")
+    login.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    if args.command == "login":
+        results = []
+        print(f"{'Setting':<24} {'verify ms':>10} {'1 thread/s':>11} {f'{args.threads} threads/s':>13} {'per core/s':>11}")
+        print("-" * 73)
+        for setting in args.settings.split(","):
+            scheme, cost = setting.split(":")
+            result = login_throughput(scheme, int(cost), args.threads, args.seconds)
+            results.append(result)
+            print(f"{setting:<24} {result['verify_ms']:>10.2f} {result['single_thread_per_s']:>11.1f} "
+                  f"{result['all_threads_per_s']:>13.1f} {result['per_core_per_s']:>11.1f}")
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"login": results, "cpus": os.cpu_count()}, f, indent=2)
+        return
+
+    if args.command == "generate":
+        start = time.perf_counter()
+        generate(args.database_file, args.products, args.customers,
+                 args.sessions or 3 * args.customers, args.orders, args.views, args.searches, args.seed)
+        print(f"Generated {args.database_file} in {time.perf_counter() - start:.1f}s")
+        return
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        print(f"Invalid mix: {e}")
+        sys.exit(2)
+    result = run(args.database_file, args.ops, mix, args.workers, args.seed)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_summary(result, baseline, args.metric)
+    regressions = compare(result, baseline, args.threshold, args.metric) if baseline else {}
+    for name, (before, after, ratio) in regressions.items():
+        print(f"REGRESSION {name}: {args.metric} {before:.2f} -> {after:.2f} ({ratio:.2f}x)")
+    if args.output:
+        if baseline:
+            result["regressions"] = {name: {"baseline": before, "current": after, "ratio": ratio}
+                                     for name, (before, after, ratio) in regressions.items()}
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import heapq
+import time
+from collections import OrderedDict
+
+
+class LeaderboardCache:
+    """Per-product counts behind the top products screen
+
+    Each board ("orders", "views") is filled by one aggregation query and then
+    kept current by increment() as this process records orders and views.
+    Boards older than ttl seconds are dropped so writes from other processes
+    show up eventually.
+    """
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.boards = {}  # kind -> (loaded_at, {pid: [name, count]})
+
+    def get(self, kind):
+        entry = self.boards.get(kind)
+        if entry is None:
+            return None
+        loaded_at, counts = entry
+        if time.monotonic() - loaded_at > self.ttl:
+            del self.boards[kind]
+            return None
+        return counts
+
+    def put(self, kind, rows):
+        """Store a board from (pid, name, count) rows"""
+        self.boards[kind] = (time.monotonic(), {pid: [name, count] for pid, name, count in rows})
+
+    def increment(self, kind, pid, name, by=1):
+        counts = self.get(kind)
+        if counts is None:
+            return
+        if pid in counts:
+            counts[pid][1] += by
+        else:
+            counts[pid] = [name, by]
+
+    def invalidate(self, kind=None):
+        if kind is None:
+            self.boards.clear()
+        else:
+            self.boards.pop(kind, None)
+
+    def top(self, kind, n):
+        """(pid, name, count) rows ranked within the top n, ties included"""
+        counts = self.get(kind)
+        if counts is None:
+            return None
+        if not counts:
+            return []
+        cutoff = heapq.nlargest(n, (count for name, count in counts.values()))[-1]
+        rows = [(pid, name, count) for pid, (name, count) in counts.items() if count >= cutoff]
+        rows.sort(key=lambda row: (-row[2], row[0]))
+        return rows
+
+
+class ProductCache:
+    """Read-through cache of product rows, LRU with a TTL
+
+    Holds at most max_items rows and roughly max_bytes of text (descr can be
+    long). Entries expire after ttl seconds so changes made by other
+    processes show up eventually; this process invalidates rows itself when
+    it changes prices or stock.
+    """
+    def __init__(self, ttl=5, max_items=1000, max_bytes=4 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.rows = OrderedDict()  # pid -> (loaded_at, size, row)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def row_size(row):
+        return sum(len(value) if isinstance(value, str) else 8 for value in row)
+
+    def get(self, pid):
+        entry = self.rows.get(pid)
+        if entry is not None and time.monotonic() - entry[0] > self.ttl:
+            self.invalidate(pid)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.rows.move_to_end(pid)
+        self.hits += 1
+        return entry[2]
+
+    def put(self, pid, row):
+        self.invalidate(pid)
+        size = self.row_size(row)
+        if size > self.max_bytes:
+            return
+        self.rows[pid] = (time.monotonic(), size, row)
+        self.size += size
+        #evict least recently used
+        while len(self.rows) > self.max_items or self.size > self.max_bytes:
+            _, (_, evicted, _) = self.rows.popitem(last=False)
+            self.size -= evicted
+
+    def invalidate(self, pid=None):
+        if pid is None:
+            self.rows.clear()
+            self.size = 0
+            return
+        entry = self.rows.pop(pid, None)
+        if entry is not None:
+            self.size -= entry[1]
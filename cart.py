@@ -0,0 +1,52 @@
+class SessionCart:
+    """A customer's cart kept in memory for the length of their session
+
+    Lines and the grand total are updated in place on add/set/remove, so
+    viewing or changing a cart doesn't go back to the database. Changes are
+    written to the cart table later (write-behind): pending holds the pids
+    changed since the last flush, with their new quantity or None if removed.
+    """
+    def __init__(self, rows=()):
+        self.lines = {}  # pid -> [name, price, qty, stock_count]
+        self.total = 0
+        self.pending = {}
+        for pid, name, price, qty, stock in rows:
+            self.lines[pid] = [name, price, qty, stock]
+            self.total += price * qty
+
+    def __contains__(self, pid):
+        return pid in self.lines
+
+    def qty(self, pid):
+        line = self.lines.get(pid)
+        return line[2] if line else 0
+
+    def stock(self, pid):
+        return self.lines[pid][3]
+
+    def set(self, pid, qty, product=None):
+        """Set a line's quantity; product (pid, name, category, price, stock_count, ...)
+        is needed for a pid that isn't in the cart yet"""
+        line = self.lines.get(pid)
+        if line is None:
+            line = self.lines[pid] = [product[1], product[3], 0, product[4]]
+        self.total += line[1] * (qty - line[2])
+        line[2] = qty
+        self.pending[pid] = qty
+
+    def remove(self, pid):
+        name, price, qty, stock = self.lines.pop(pid)
+        self.total -= price * qty
+        self.pending[pid] = None
+
+    def items(self):
+        """(pid, name, price, qty, stock_count, line total) in pid order"""
+        return [(pid, name, price, qty, stock, price * qty)
+                for pid, (name, price, qty, stock) in sorted(self.lines.items())]
+
+    def pending_writes(self):
+        """(upserts [(pid, qty)], deletes [pid]) not written yet; clear
+        pending once they are committed"""
+        upserts = [(pid, qty) for pid, qty in self.pending.items() if qty is not None]
+        deletes = [pid for pid, qty in self.pending.items() if qty is None]
+        return upserts, deletes
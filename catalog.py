@@ -0,0 +1,229 @@
+"""Bulk product catalog import/export
+
+Import (insert new pids, update existing ones) from CSV or JSONL:
+    python catalog.py import prj-test.db products.csv
+Export the whole catalog without loading it into memory:
+    python catalog.py export prj-test.db products.jsonl
+
+CSV files need a header row. category and descr may be left out of a record,
+in which case an existing product keeps its current value.
+"""
+import argparse
+import csv
+import json
+import sqlite3
+import sys
+import time
+from collections import namedtuple
+from contextlib import nullcontext
+
+FIELDS = ("pid", "name", "category", "price", "stock_count", "descr")
+BATCH_SIZE = 5000
+
+# category/descr left out of a record (None) keep the stored value
+UPSERT_SQL = """
+    INSERT INTO products (pid, name, category, price, stock_count, descr)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(pid) DO UPDATE SET
+        name = excluded.name,
+        category = COALESCE(excluded.category, products.category),
+        price = excluded.price,
+        stock_count = excluded.stock_count,
+        descr = COALESCE(excluded.descr, products.descr)
+"""
+
+ImportResult = namedtuple("ImportResult", ["loaded", "rejected"])  # rejected: [(line, reason)]
+
+
+# --- readers and writers (streaming, one record at a time) ---
+
+def file_format(path, fmt=None):
+    if fmt:
+        return fmt
+    if path.endswith(".csv"):
+        return "csv"
+    if path.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    raise ValueError(f"Cannot tell the format of {path}, use --format")
+
+
+def read_records(f, fmt):
+    """Yield (line number, dict) from an open CSV or JSONL file"""
+    if fmt == "csv":
+        reader = csv.DictReader(f)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                record = e
+            yield line_no, record
+
+
+def write_records(f, fmt, fields, rows):
+    """Write rows (tuples in fields order) as CSV or JSONL, returns the row count"""
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(f)
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in rows:
+            f.write(json.dumps(dict(zip(fields, row))) + "\n")
+            count += 1
+    return count
+
+
+# --- validation ---
+
+def validate(record):
+    """Convert one record to a products row, raising ValueError with the reason
+    if it would break the table's NOT NULL/CHECK constraints"""
+    if not isinstance(record, dict):
+        raise ValueError(f"not a record: {record}")
+    #a falsy value such as JSON 0 is still a value, only None/"" are missing
+    pid = "" if record.get("pid") is None else str(record["pid"]).strip()
+    name = "" if record.get("name") is None else str(record["name"]).strip()
+    if not pid:
+        raise ValueError("missing pid")
+    if not name:
+        raise ValueError("missing name")
+    try:
+        price = float(record.get("price"))
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid price: {record.get('price')!r}")
+    if not price >= 0:  # also rejects nan
+        raise ValueError(f"price must be >= 0: {price}")
+    try:
+        stock = record.get("stock_count")
+        if isinstance(stock, float) and not stock.is_integer():
+            raise ValueError
+        stock = int(stock)
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid stock_count: {record.get('stock_count')!r}")
+    if stock < 0:
+        raise ValueError(f"stock_count must be >= 0: {stock}")
+    #empty CSV cells count as not given
+    category = record.get("category") or None
+    descr = record.get("descr") or None
+    return pid, name, category, price, stock, descr
+
+
+# --- import/export ---
+
+def import_products(conn, records, batch_size=BATCH_SIZE, commit=None):
+    """Upsert (line, record) pairs into products in batches of batch_size
+
+    Each batch is one executemany and one commit. Invalid records are rejected
+    before they reach the database; if a batch still fails on a constraint it
+    is rolled back and retried row by row so that only the bad rows are lost.
+    """
+    commit = commit or conn.commit
+    loaded = 0
+    rejected = []
+    batch = []
+
+    def write(batch):
+        try:
+            conn.executemany(UPSERT_SQL, [row for _, row in batch])
+            commit()
+            return len(batch)
+        except sqlite3.IntegrityError:
+            conn.rollback()
+        count = 0
+        for line, row in batch:
+            try:
+                conn.execute(UPSERT_SQL, row)  # a failing statement leaves the transaction intact
+                count += 1
+            except sqlite3.IntegrityError as e:
+                rejected.append((line, str(e)))
+        commit()
+        return count
+
+    for line, record in records:
+        try:
+            batch.append((line, validate(record)))
+        except ValueError as e:
+            rejected.append((line, str(e)))
+            continue
+        if len(batch) >= batch_size:
+            loaded += write(batch)
+            batch = []
+    if batch:
+        loaded += write(batch)
+    return ImportResult(loaded, rejected)
+
+
+def export_products(conn, batch_size=BATCH_SIZE):
+    """Yield every product row in pid order, batch_size rows in memory at a time"""
+    return stream_rows(conn.execute(f"SELECT {', '.join(FIELDS)} FROM products ORDER BY pid"), batch_size)
+
+
+def stream_rows(cursor, batch_size=BATCH_SIZE):
+    """Yield a query's rows, fetching batch_size at a time"""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def open_file(path, mode):
+    if path == "-":
+        return nullcontext(sys.stdin if "r" in mode else sys.stdout)
+    return open(path, mode, newline="", encoding="utf-8")
+
+
+def main():
+    from service import ECommerceService
+
+    parser = argparse.ArgumentParser(description="Bulk product catalog import/export")
+    parser.add_argument("command", choices=("import", "export"))
+    parser.add_argument("database_file")
+    parser.add_argument("file", help="CSV or JSONL file, - for stdin/stdout")
+    parser.add_argument("--format", choices=("csv", "jsonl"))
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--max-errors", type=int, default=20, help="rejected rows to print")
+    args = parser.parse_args()
+
+    try:
+        fmt = file_format(args.file, args.format)
+    except ValueError as e:
+        print(e)
+        sys.exit(2)
+    service = ECommerceService(args.database_file)
+    try:
+        service.connect()
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+        sys.exit(1)
+    start = time.perf_counter()
+    try:
+        if args.command == "import":
+            with open_file(args.file, "r") as f:
+                result = service.import_products(read_records(f, fmt), args.batch_size)
+            print(f"Loaded {result.loaded} products, rejected {len(result.rejected)} "
+                  f"in {time.perf_counter() - start:.1f}s")
+            for line, reason in result.rejected[:args.max_errors]:
+                print(f"  line {line}: {reason}")
+            if len(result.rejected) > args.max_errors:
+                print(f"  ... {len(result.rejected) - args.max_errors} more")
+        else:
+            with open_file(args.file, "w") as f:
+                count = write_records(f, fmt, FIELDS, service.export_products(args.batch_size))
+            print(f"Exported {count} products in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
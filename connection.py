@@ -0,0 +1,89 @@
+import configparser
+import random
+import sqlite3
+import time
+
+# Connection profiles. "default" is plain SQLite (rollback journal), "concurrent"
+# is for several processes sharing one database file: WAL lets readers run
+# alongside the writer, and write transactions start with BEGIN IMMEDIATE so
+# they queue on busy_timeout instead of failing when upgrading a read lock.
+PROFILES = {
+    "default": {
+        "journal_mode": None,
+        "busy_timeout": 5000,
+        "synchronous": None,
+        "mmap_size": None,
+        "cache_size": None,
+        "isolation_level": "",
+        "busy_retries": 3,
+    },
+    "concurrent": {
+        "journal_mode": "WAL",
+        "busy_timeout": 10000,
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,  # negative = KiB
+        "isolation_level": "IMMEDIATE",
+        "busy_retries": 5,
+    },
+}
+
+INT_SETTINGS = {"busy_timeout", "mmap_size", "cache_size", "busy_retries"}
+
+
+def load_profile(name="default", config_file=None, overrides=None):
+    """Settings for a connection: a named profile, then a config file's
+    [connection] section, then explicit overrides (None values are ignored)"""
+    settings = dict(PROFILES["default"])
+    if config_file:
+        parser = configparser.ConfigParser()
+        if not parser.read(config_file):
+            raise ValueError(f"Cannot read config file: {config_file}")
+        section = parser["connection"] if parser.has_section("connection") else {}
+        name = section.get("profile", name)
+        settings.update(PROFILES[name])
+        for key, value in section.items():
+            if key == "profile":
+                continue
+            if key not in settings:
+                raise ValueError(f"Unknown connection setting: {key}")
+            settings[key] = int(value) if key in INT_SETTINGS else value
+    else:
+        settings.update(PROFILES[name])
+    for key, value in (overrides or {}).items():
+        if value is not None:
+            settings[key] = value
+    return settings
+
+
+def open_connection(db_name, settings, cached_statements=128, factory=sqlite3.Connection):
+    """Open a connection and apply the profile's pragmas"""
+    conn = sqlite3.connect(db_name, timeout=settings["busy_timeout"] / 1000,
+                           isolation_level=settings["isolation_level"],
+                           cached_statements=cached_statements, factory=factory)
+    conn.execute(f"PRAGMA busy_timeout = {int(settings['busy_timeout'])}")
+    if settings["journal_mode"]:
+        conn.execute(f"PRAGMA journal_mode = {settings['journal_mode']}")
+    if settings["synchronous"]:
+        conn.execute(f"PRAGMA synchronous = {settings['synchronous']}")
+    if settings["mmap_size"] is not None:
+        conn.execute(f"PRAGMA mmap_size = {int(settings['mmap_size'])}")
+    if settings["cache_size"] is not None:
+        conn.execute(f"PRAGMA cache_size = {int(settings['cache_size'])}")
+    return conn
+
+
+def is_busy(error):
+    return isinstance(error, sqlite3.OperationalError) and (
+        "locked" in str(error) or "busy" in str(error))
+
+
+def retry_on_busy(func, retries=3, base_delay=0.05):
+    """Call func, retrying with jittered exponential backoff on SQLITE_BUSY"""
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except sqlite3.OperationalError as e:
+            if not is_busy(e) or attempt == retries:
+                raise
+            time.sleep(base_delay * (2 ** attempt) * (1 + random.random()))
@@ -0,0 +1,136 @@
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+# seconds a buffered row may wait before it is written
+MAX_DELAY = 5.0
+
+# Analytics events that are buffered instead of written on every click. Their
+# timestamps (part of the key) come from timestamp(), so a session's events never
+# share one; a duplicate row is still dropped rather than failing the batch.
+EVENT_SQL = {
+    "search": """
+        INSERT OR IGNORE INTO search (cid, sessionNo, ts, query)
+        VALUES (?, ?, ?, ?)
+    """,
+    "viewedProduct": """
+        INSERT OR IGNORE INTO viewedProduct (cid, sessionNo, ts, pid)
+        VALUES (?, ?, ?, ?)
+    """,
+}
+
+last_timestamp = None
+timestamp_lock = threading.Lock()
+
+
+def timestamp():
+    """Event time to the microsecond, later than any this process handed out
+    before (so two clicks in the same clock tick still get distinct keys)"""
+    global last_timestamp
+    with timestamp_lock:
+        ts = datetime.now()
+        if last_timestamp is not None and ts <= last_timestamp:
+            ts = last_timestamp + timedelta(microseconds=1)
+        last_timestamp = ts
+    return ts.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+class EventLog:
+    """Buffered writer for search and viewedProduct rows
+
+    Rows are written with one executemany per table and a single commit once
+    max_rows are buffered, the oldest row is max_delay seconds old, or flush()
+    is called (end of session, close). If a threshold flush fails the rows are
+    kept for the next one, up to max_buffered rows; beyond that the oldest are
+    dropped. Explicit flush() calls raise the error. With write given, flush()
+    passes it {table: rows} instead of writing them on conn itself.
+
+    The max_delay check above only runs when a row is logged, so a process
+    that keeps logs for idle sessions (the server) also calls take_stale()
+    on a timer and writes those rows itself; the buffers are locked for that.
+    """
+    def __init__(self, conn, max_rows=100, max_delay=MAX_DELAY, max_buffered=10000, commit=None,
+                 write=None):
+        self.conn = conn
+        self.commit = commit or conn.commit
+        self.write = write
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_buffered = max_buffered
+        self.buffers = {table: [] for table in EVENT_SQL}
+        self.size = 0
+        self.oldest = None
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def log(self, table, row):
+        """Buffer one row, flushing if a threshold is reached"""
+        with self.lock:
+            if self.size >= self.max_buffered:
+                self.drop_oldest()
+            self.buffers[table].append(row)
+            self.size += 1
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            due = self.size >= self.max_rows or time.monotonic() - self.oldest >= self.max_delay
+        if due:
+            try:
+                self.flush()
+            except sqlite3.Error:
+                pass  # rows stay buffered for the next flush
+
+    def drop_oldest(self):
+        #rows carry their timestamp in position 2
+        table = min((t for t in self.buffers if self.buffers[t]), key=lambda t: self.buffers[t][0][2])
+        self.buffers[table].pop(0)
+        self.size -= 1
+        self.dropped += 1
+
+    def take(self):
+        """Remove and return the buffered rows as {table: rows}"""
+        with self.lock:
+            batches = {table: rows for table, rows in self.buffers.items() if rows}
+            self.buffers = {table: [] for table in EVENT_SQL}
+            self.size = 0
+            self.oldest = None
+        return batches
+
+    def take_stale(self):
+        """take() if the oldest row is max_delay seconds old, else {}"""
+        with self.lock:
+            if self.oldest is None or time.monotonic() - self.oldest < self.max_delay:
+                return {}
+        return self.take()
+
+    def put_back(self, batches):
+        """Buffer rows again after a failed write (ahead of newer ones)"""
+        with self.lock:
+            for table, rows in batches.items():
+                self.buffers[table][:0] = rows
+                self.size += len(rows)
+            if self.size:
+                #they were already due
+                self.oldest = time.monotonic() - self.max_delay
+            while self.size > self.max_buffered:
+                self.drop_oldest()
+
+    def flush(self):
+        """Write all buffered rows in one transaction"""
+        batches = self.take()
+        if not batches:
+            return
+        try:
+            if self.write is not None:
+                self.write(batches)
+            else:
+                try:
+                    for table, rows in batches.items():
+                        self.conn.executemany(EVENT_SQL[table], rows)
+                    self.commit()
+                except sqlite3.Error:
+                    self.conn.rollback()
+                    raise
+        except sqlite3.Error:
+            self.put_back(batches)
+            raise
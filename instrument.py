@@ -0,0 +1,318 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+import queries
+from queries import BUILDERS, STATEMENTS, shapes
+
+# Latency histogram bucket upper bounds, milliseconds
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float("inf"))
+# The progress handler runs every this many SQLite VM instructions
+PROGRESS_STEPS = 1000
+# Wrappers between a caller and the cursor; the call site is the frame above them
+WRAPPERS = {"execute", "executemany", "report"}
+# frames in these files are between the caller and the cursor too (QueryRegistry.run
+# counts the statement on its way to it)
+SKIPPED = {os.path.abspath(__file__), os.path.abspath(queries.__file__)}
+
+
+def normalize(sql):
+    return " ".join(sql.split())
+
+
+def statement_names():
+    """{normalized SQL: name} for the query registry's statements and shapes"""
+    names = {}
+    for name, shape in shapes():
+        sql = BUILDERS[name](*shape) if shape else STATEMENTS[name]
+        names[normalize(sql)] = f"{name}{list(shape)}" if shape else name
+    return names
+
+
+def redacted(parameters):
+    """Parameter types only, e.g. "(str, int)" """
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{name}: {type(value).__name__}" for name, value in parameters.items()) + "}"
+    return "(" + ", ".join(type(value).__name__ for value in parameters) + ")"
+
+
+def call_site():
+    """"module.function" of the code that ran the statement"""
+    frame = sys._getframe(2)
+    while frame is not None and (frame.f_code.co_name in WRAPPERS
+                                 or os.path.abspath(frame.f_code.co_filename) in SKIPPED):
+        frame = frame.f_back
+    if frame is None:
+        return "?"
+    module = os.path.splitext(os.path.basename(frame.f_code.co_filename))[0]
+    return f"{module}.{frame.f_code.co_name}"
+
+
+class StatementStats:
+    """Counts and a latency histogram for one statement at one call site"""
+    def __init__(self, label):
+        self.label = label
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.steps = 0
+        self.buckets = [0] * len(BUCKETS_MS)
+
+    def add(self, seconds, rows, steps, error=False):
+        ms = seconds * 1000
+        self.count += 1
+        self.errors += error
+        self.total += ms
+        self.max = max(self.max, ms)
+        self.rows += rows
+        self.steps += steps
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                break
+
+    def percentile(self, q):
+        """Upper bound (ms) of the bucket holding the q-th fraction of calls"""
+        seen = 0
+        for bound, hits in zip(BUCKETS_MS, self.buckets):
+            seen += hits
+            if seen >= q * self.count:
+                return min(bound, self.max)
+        return self.max
+
+
+class Instrumentation:
+    """Per-statement timing for connections opened with InstrumentedConnection
+
+    Each statement is timed from execute until its rows are fetched and
+    counted under (call site, SQL). Statements taking slow_ms or longer are
+    appended to slow_log with their parameters and EXPLAIN QUERY PLAN. A
+    progress handler counts VM instructions (in steps of PROGRESS_STEPS) per
+    statement, and the trace callback counts every statement by its first
+    keyword, including the BEGIN/COMMIT the sqlite3 module issues itself.
+    One instance can be shared by connections on several threads.
+
+    Parameters include password hashes and emails, so the slow log only shows
+    their types unless log_params is set.
+    """
+    def __init__(self, slow_ms=100, slow_log=None, dump_file=None, log_params=False):
+        self.slow_ms = slow_ms
+        self.slow_log = open(slow_log, "a") if slow_log else None
+        self.log_params = log_params
+        self.dump_file = dump_file
+        self.names = statement_names()
+        self.stats = {}  # (site, normalized sql) -> StatementStats
+        self.traced = {}  # first keyword -> statements seen by the trace callback
+        self.lock = threading.Lock()
+
+    def attach(self, conn):
+        """Start instrumenting an InstrumentedConnection"""
+        conn.instrumentation = self
+        conn.vm_steps = 0
+
+        def progress():
+            conn.vm_steps += 1
+            return 0
+
+        conn.set_progress_handler(progress, PROGRESS_STEPS)
+        conn.set_trace_callback(self.trace)
+
+    def trace(self, sql):
+        sql = sql.lstrip()
+        if sql.startswith("--"):
+            #statements run by triggers and virtual tables (FTS)
+            keyword = "nested"
+        else:
+            keyword = sql.split(None, 1)[0].rstrip(";").upper() if sql else "?"
+        if keyword == "EXPLAIN":
+            return
+        with self.lock:
+            self.traced[keyword] = self.traced.get(keyword, 0) + 1
+
+    def label(self, sql):
+        sql = normalize(sql)
+        name = self.names.get(sql)
+        return name if name is not None else (sql if len(sql) <= 60 else sql[:57] + "...")
+
+    def record(self, conn, site, sql, parameters, seconds, rows, steps, error=False):
+        key = (site, normalize(sql))
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = StatementStats(self.label(sql))
+            stats.add(seconds, rows, steps * PROGRESS_STEPS, error)
+        if self.slow_log is not None and seconds * 1000 >= self.slow_ms:
+            self.log_slow(conn, site, sql, parameters, seconds)
+
+    def log_slow(self, conn, site, sql, parameters, seconds):
+        try:
+            #a plain cursor, so the EXPLAIN itself isn't timed
+            plan = [row[3] for row in sqlite3.Cursor(conn).execute(f"EXPLAIN QUERY PLAN {sql}", parameters)]
+        except sqlite3.Error as e:
+            plan = [f"(no plan: {e})"]
+        lines = [f"{datetime.now():%Y-%m-%d %H:%M:%S} {seconds * 1000:.1f} ms {site}",
+                 f"  {normalize(sql)}",
+                 f"  params: {parameters!r}" if self.log_params else f"  params: {redacted(parameters)}"]
+        lines += [f"  plan: {detail}" for detail in plan]
+        with self.lock:
+            self.slow_log.write("\n".join(lines) + "\n")
+            self.slow_log.flush()
+
+    def summary(self):
+        """One dict per (call site, statement), most total time first"""
+        with self.lock:
+            entries = [(site, stats) for (site, _), stats in self.stats.items()]
+            return [{
+                "site": site,
+                "statement": stats.label,
+                "count": stats.count,
+                "errors": stats.errors,
+                "total_ms": stats.total,
+                "mean_ms": stats.total / stats.count,
+                "p50_ms": stats.percentile(0.50),
+                "p95_ms": stats.percentile(0.95),
+                "max_ms": stats.max,
+                "rows": stats.rows,
+                "vm_steps": stats.steps,
+                "histogram": dict(zip((f"<={bound}" for bound in BUCKETS_MS), stats.buckets)),
+            } for site, stats in sorted(entries, key=lambda entry: -entry[1].total)]
+
+    def dump(self, out=None):
+        """Print the per-statement table and histograms"""
+        out = out or sys.stdout
+        rows = self.summary()
+        print(f"\n{'call site':<28} {'statement':<40} {'count':>7} {'total ms':>10} "
+              f"{'mean':>8} {'p95':>8} {'max':>8} {'rows':>8}", file=out)
+        print("-" * 124, file=out)
+        for row in rows:
+            print(f"{row['site'][:28]:<28} {row['statement'][:40]:<40} {row['count']:>7} "
+                  f"{row['total_ms']:>10.1f} {row['mean_ms']:>8.2f} {row['p95_ms']:>8.2f} "
+                  f"{row['max_ms']:>8.2f} {row['rows']:>8}", file=out)
+            buckets = "  ".join(f"{bound}ms:{hits}" for bound, hits in row["histogram"].items() if hits)
+            print(f"{'':<28} {buckets}", file=out)
+        with self.lock:
+            traced = ", ".join(f"{keyword} {count}" for keyword, count in
+                               sorted(self.traced.items(), key=lambda item: -item[1]))
+        print(f"\nAll statements by type: {traced or 'none'}", file=out)
+
+    def close(self):
+        """Dump to dump_file ("-" for stdout) if given and close the slow log"""
+        if self.dump_file == "-":
+            self.dump()
+        elif self.dump_file:
+            with open(self.dump_file, "w") as f:
+                self.dump(f)
+        if self.slow_log is not None:
+            self.slow_log.close()
+            self.slow_log = None
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that reports each statement to its connection's Instrumentation
+
+    A query is timed through its last fetch (or until the cursor runs another
+    statement, is closed or is dropped), so the time includes stepping its rows.
+    """
+    pending = None  # [site, sql, parameters, seconds, rows, steps at start]
+
+    def execute(self, sql, parameters=(), /):
+        return self.timed(super().execute, sql, parameters, parameters)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        seq_of_parameters = list(seq_of_parameters)
+        return self.timed(super().executemany, sql, seq_of_parameters,
+                          seq_of_parameters[0] if seq_of_parameters else ())
+
+    def timed(self, run, sql, parameters, sample):
+        self.finish()
+        instrumentation = getattr(self.connection, "instrumentation", None)
+        if instrumentation is None:
+            run(sql, parameters)
+            return self
+        site = call_site()
+        steps = self.connection.vm_steps
+        start = time.perf_counter()
+        try:
+            run(sql, parameters)
+        except sqlite3.Error:
+            instrumentation.record(self.connection, site, sql, sample, time.perf_counter() - start,
+                                   0, self.connection.vm_steps - steps, error=True)
+            raise
+        self.pending = [site, sql, sample, time.perf_counter() - start, 0, steps]
+        if self.description is None:
+            #no result rows to wait for
+            self.pending[4] = max(self.rowcount, 0)
+            self.finish()
+        return self
+
+    def finish(self):
+        pending, self.pending = self.pending, None
+        if pending is not None:
+            site, sql, sample, seconds, rows, steps = pending
+            self.connection.instrumentation.record(self.connection, site, sql, sample, seconds, rows,
+                                                   self.connection.vm_steps - steps)
+
+    def fetched(self, start, rows, done):
+        if self.pending is not None:
+            self.pending[3] += time.perf_counter() - start
+            self.pending[4] += rows
+            if done:
+                self.finish()
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self.fetched(start, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        size = self.arraysize if size is None else size
+        rows = super().fetchmany(size)
+        self.fetched(start, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self.fetched(start, len(rows), True)
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self.fetched(start, 0, True)
+            raise
+        self.fetched(start, 1, False)
+        return row
+
+    def close(self):
+        self.finish()
+        super().close()
+
+    def __del__(self):
+        if self.pending is not None:
+            try:
+                self.finish()
+            except sqlite3.Error:
+                pass
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors (including execute() shortcuts) are instrumented"""
+    instrumentation = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=(), /):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters, /):
+        return self.cursor().executemany(sql, parameters)
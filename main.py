@@ -1,64 +1,53 @@
 import sqlite3
 import sys
 import getpass
-from datetime import datetime, timedelta
-import hashlib
+import argparse
+import signal
+import catalog
+from connection import PROFILES, load_profile
+from service import ECommerceService, ServiceError, ORDER_FIELDS, PAGE_SIZE
+from passwords import DEFAULT_COST, SCHEMES, PasswordHasher
+from reports import ReportEngine
+from instrument import Instrumentation
 
 class ECommerceSystem:
-    def __init__(self, db_name):
+    """Menu-driven command line front end over ECommerceService"""
+    def __init__(self, db_name, **service_options):
         self.db_name = db_name
-        self.conn = None
-        self.cursor = None
-        self.current_user = None
-        self.current_role = None
-        self.session_no = None
+        self.service = ECommerceService(db_name, **service_options)
+        self.session = None
     def connect(self):
         try:
-            self.conn = sqlite3.connect(self.db_name)
-            self.cursor = self.conn.cursor()
-            self.cursor.execute("PRAGMA foreign_keys = ON")
+            applied = self.service.connect()
+            if applied:
+                print(f"Upgraded database schema to version {applied[-1]}")
             print(f"Connected to database: {self.db_name}")
         except sqlite3.Error as e:
             print(f"Database connection error: {e}")
             sys.exit(1)
+
+    def check_query_plans(self):
+        """Print EXPLAIN QUERY PLAN findings for the hot queries"""
+        ok = True
+        for name, scans in self.service.check_query_plans().items():
+            if scans:
+                ok = False
+                print(f"FULL SCAN  {name}: {'; '.join(scans)}")
+            else:
+                print(f"ok         {name}")
+        return ok
     
     def close(self):
         """Close con"""
-        if self.conn:
-            self.conn.close()
-    def hash_password(self, password):
-        return hashlib.sha256(password.encode()).hexdigest()
-    def start_session(self, cid):
         try:
-            #next session number
-            self.cursor.execute("""
-                SELECT COALESCE(MAX(sessionNo), 0) + 1 
-                FROM sessions 
-                WHERE cid = ?
-            """, (cid,))
-            session_no = self.cursor.fetchone()[0]
-            start_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            self.cursor.execute("""
-                INSERT INTO sessions (cid, sessionNo, start_time)
-                VALUES (?, ?, ?)
-            """, (cid, session_no, start_time))
-            self.conn.commit()
-            self.session_no = session_no
-            return session_no
+            self.service.close()
         except sqlite3.Error as e:
-            print(f"Error starting session: {e}")
-            return None
+            print(f"Error recording events: {e}")
     
     def end_session(self):
-        if self.current_user and self.session_no:
+        if self.session:
             try:
-                end_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                self.cursor.execute("""
-                    UPDATE sessions 
-                    SET end_time = ? 
-                    WHERE cid = ? AND sessionNo = ?
-                """, (end_time, self.current_user, self.session_no))
-                self.conn.commit()
+                self.service.logout(self.session)
             except sqlite3.Error as e:
                 print(f"Error ending session: {e}")
     
@@ -90,24 +79,11 @@ class ECommerceSystem:
         uid = input("User ID: ").strip()
         pwd = getpass.getpass("Password: ")
         
-        pwd_hash = self.hash_password(pwd)
-        
         try:
-            self.cursor.execute("""
-                SELECT uid, role FROM users 
-                WHERE uid = ? AND pwd = ?
-            """, (uid, pwd_hash))
-            
-            result = self.cursor.fetchone()
-            
-            if result:
-                self.current_user = result[0]
-                self.current_role = result[1]
+            session = self.service.login(uid, pwd)
+            if session:
+                self.session = session
                 print(f"\nLogin successful! Welcome, {uid}")
-                
-                # Start session for customers
-                if self.current_role == 'customer':
-                    self.start_session(self.current_user)
                 return True
             else:
                 print("Invalid user ID or password.")
@@ -126,34 +102,12 @@ class ECommerceSystem:
         if pwd != pwd_confirm:
             print("Passwords do not match!")
             return
-        #if email exists
         try:
-            self.cursor.execute("""
-                SELECT cid FROM customers WHERE email = ?
-            """, (email,))
-            if self.cursor.fetchone():
-                print("Email already in use!")
-                return
-            #unique user ID
-            self.cursor.execute("SELECT COALESCE(MAX(CAST(uid AS INTEGER)), 0) + 1 FROM users")
-            new_uid = str(self.cursor.fetchone()[0])
-            pwd_hash = self.hash_password(pwd)
-            #add to users table
-            self.cursor.execute("""
-                INSERT INTO users (uid, pwd, role)
-                VALUES (?, ?, 'customer')
-            """, (new_uid, pwd_hash))
-            
-            #customers table
-            self.cursor.execute("""
-                INSERT INTO customers (cid, name, email)
-                VALUES (?, ?, ?)
-            """, (new_uid, name, email))
-            self.conn.commit()
+            new_uid = self.service.signup(name, email, pwd)
             print(f"\nRegistration successful! Your user ID is: {new_uid}")
-            
+        except ServiceError as e:
+            print(e)
         except sqlite3.Error as e:
-            self.conn.rollback()
             print(f"Registration error: {e}")
     def customer_menu(self):
         """Display customer menu"""
@@ -165,7 +119,8 @@ class ECommerceSystem:
             print("2. View Cart")
             print("3. Checkout")
             print("4. My Orders")
-            print("5. Logout")
+            print("5. Export Order History")
+            print("6. Logout")
             print("="*50)
             
             choice = input("Enter your choice: ").strip()
@@ -178,6 +133,8 @@ class ECommerceSystem:
             elif choice == '4':
                 self.view_orders()
             elif choice == '5':
+                self.export_orders()
+            elif choice == '6':
                 self.end_session()
                 print("Logged out successfully.")
                 break
@@ -192,73 +149,35 @@ class ECommerceSystem:
         if not query:
             print("Please enter at least one keyword.")
             return
-        #Record search
-        ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        try:
-            self.cursor.execute("""
-                INSERT INTO search (cid, sessionNo, ts, query)
-                VALUES (?, ?, ?, ?)
-            """, (self.current_user, self.session_no, ts, query))
-            self.conn.commit()
-        except sqlite3.Error as e:
-            print(f"Error recording search: {e}")
-        #Split keywords and build query
-        keywords = query.lower().split()
-        where_conditions = []
-        params = []
-        for keyword in keywords:
-            where_conditions.append("(LOWER(name) LIKE ? OR LOWER(descr) LIKE ?)")
-            params.extend([f"%{keyword}%", f"%{keyword}%"])
+        choice = input("Sort by (1) name, (2) best selling or (3) best match? [1]: ").strip()
+        sort = {"2": "popular", "3": "relevance"}.get(choice, "name")
         
-        where_clause = " AND ".join(where_conditions)
-        sql = f"""
-            SELECT pid, name, category, price, stock_count
-            FROM products
-            WHERE {where_clause}
-            ORDER BY name
-        """
+        def fetch_page(key, forward):
+            return self.service.search(self.session, query, key, forward, sort=sort)
         
         try:
-            self.cursor.execute(sql, params)
-            results = self.cursor.fetchall()
-            if not results:
+            first = fetch_page(None, True)
+            if not first.total:
                 print("No products found.")
                 return
-            # Pagination
-            self.paginate_results(results, self.display_product_row, 
-                                self.product_detail_view)
+            # Pagination (best match pages through the top matches by position)
+            if sort == "relevance":
+                self.paginate_query(first, fetch_page, lambda p: p[5],
+                                    lambda p: self.display_product_row(p[:5]), self.product_detail_view)
+            else:
+                self.paginate_query(first, fetch_page,
+                                    (lambda p: (p[5], p[0])) if sort == "popular" else (lambda p: (p[1], p[0])),
+                                    self.display_product_row, self.product_detail_view)
         except sqlite3.Error as e:
             print(f"Search error: {e}")
     
     def display_product_row(self, product):
         """Display product row"""
-        pid, name, category, price, stock = product
-        print(f"  {pid:5} | {name:30} | {category:15} | ${price:8.2f} | Stock: {stock}")
-    def product_detail_view(self, product):
-        """Display product view"""
-        pid = product[0]
-        #product details
-        self.cursor.execute("""
-            SELECT pid, name, category, price, stock_count, descr
-            FROM products WHERE pid = ?
-        """, (pid,))
-        details = self.cursor.fetchone()
-        if not details:
-            print("Product not found.")
-            return
-        
+        pid, name, category, price, stock = product[:5]
+        sold = f" | Sold: {product[5]}" if len(product) > 5 else ""
+        print(f"  {pid:5} | {name:30} | {category:15} | ${price:8.2f} | Stock: {stock}{sold}")
+    def display_product(self, details):
         pid, name, category, price, stock, descr = details
-        # Record view
-        ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        try:
-            self.cursor.execute("""
-                INSERT INTO viewedProduct (cid, sessionNo, ts, pid)
-                VALUES (?, ?, ?, ?)
-            """, (self.current_user, self.session_no, ts, pid))
-            self.conn.commit()
-        except sqlite3.Error as e:
-            print(f"Error recording view: {e}")
-        
         print("\n" + "="*60)
         print(f"Product ID: {pid}")
         print(f"Name: {name}")
@@ -267,6 +186,15 @@ class ECommerceSystem:
         print(f"Stock: {stock}")
         print(f"Description: {descr}")
         print("="*60)
+    def product_detail_view(self, product):
+        """Display product view"""
+        try:
+            details = self.service.product(self.session, product[0])
+        except ServiceError as e:
+            print(e)
+            return
+        self.display_product(details)
+        pid, stock = details[0], details[4]
         #add to cart
         if stock > 0:
             add = input("\nAdd to cart? (y/n): ").strip().lower()
@@ -277,71 +205,40 @@ class ECommerceSystem:
     
     def add_to_cart(self, pid, available_stock):
         try:
-            #Check if in cart
-            self.cursor.execute("""
-                SELECT qty FROM cart
-                WHERE cid = ? AND sessionNo = ? AND pid = ?
-            """, (self.current_user, self.session_no, pid))
-            
-            existing = self.cursor.fetchone()
-            if existing:
-                new_qty = existing[0] + 1
-                if new_qty > available_stock:
-                    print("Cannot add more - insufficient stock!")
-                    return
-                self.cursor.execute("""
-                    UPDATE cart SET qty = ?
-                    WHERE cid = ? AND sessionNo = ? AND pid = ?
-                """, (new_qty, self.current_user, self.session_no, pid))
-            else:
-                self.cursor.execute("""
-                    INSERT INTO cart (cid, sessionNo, pid, qty)
-                    VALUES (?, ?, ?, 1)
-                """, (self.current_user, self.session_no, pid))
-            
-            self.conn.commit()
+            self.service.add_to_cart(self.session, pid, available_stock)
             print("Product added to cart!")
+        except ServiceError as e:
+            print(e)
         except sqlite3.Error as e:
             print(f"Error adding to cart: {e}")
-            self.conn.rollback()
+    
+    def display_cart(self, cart):
+        print(f"\n{'PID':<6} {'Name':<30} {'Price':<10} {'Qty':<5} {'Total':<10}")
+        print("-" * 65)
+        for item in cart.items:
+            pid, name, price, qty, stock, total = item
+            print(f"{pid:<6} {name:<30} ${price:<9.2f} {qty:<5} ${total:<9.2f}")
+        print("-" * 65)
+        print(f"{'GRAND TOTAL:':<51} ${cart.total:.2f}")
     
     def view_cart(self):
         """View and manage cart"""
         print("\n--- SHOPPING CART ---")
         try:
-            self.cursor.execute("""
-                SELECT c.pid, p.name, p.price, c.qty, p.stock_count,
-                       (p.price * c.qty) as total
-                FROM cart c
-                JOIN products p ON c.pid = p.pid
-                WHERE c.cid = ? AND c.sessionNo = ?
-            """, (self.current_user, self.session_no))
-            
-            cart_items = self.cursor.fetchall()
-            if not cart_items:
+            cart = self.service.cart(self.session)
+            if not cart.items:
                 print("Your cart is empty.")
                 return
-            
-            print(f"\n{'PID':<6} {'Name':<30} {'Price':<10} {'Qty':<5} {'Total':<10}")
-            print("-" * 65)
-            
-            grand_total = 0
-            for item in cart_items:
-                pid, name, price, qty, stock, total = item
-                print(f"{pid:<6} {name:<30} ${price:<9.2f} {qty:<5} ${total:<9.2f}")
-                grand_total += total
-            
-            print("-" * 65)
-            print(f"{'GRAND TOTAL:':<51} ${grand_total:.2f}")
+            self.display_cart(cart)
             print("\n1. Update quantity")
             print("2. Remove item")
             print("3. Back to menu")
             
             choice = input("Enter choice: ").strip()
             if choice == '1':
-                self.update_cart_quantity(cart_items)
+                self.update_cart_quantity(cart.items)
             elif choice == '2':
-                self.remove_from_cart(cart_items)
+                self.remove_from_cart(cart.items)
         except sqlite3.Error as e:
             print(f"Error viewing cart: {e}")
     
@@ -356,71 +253,36 @@ class ECommerceSystem:
         stock = item[4]
         try:
             new_qty = int(input(f"Enter new quantity (available: {stock}): ").strip())
-            
-            if new_qty <= 0:
-                print("Quantity must be positive.")
-                return
-            if new_qty > stock:
-                print("Insufficient stock!")
-                return
-            self.cursor.execute("""
-                UPDATE cart SET qty = ?
-                WHERE cid = ? AND sessionNo = ? AND pid = ?
-            """, (new_qty, self.current_user, self.session_no, pid))
-            self.conn.commit()
+            self.service.update_cart_quantity(self.session, pid, new_qty)
             print("Quantity updated!")
         except ValueError:
             print("Invalid quantity.")
+        except ServiceError as e:
+            print(e)
         except sqlite3.Error as e:
             print(f"Error updating cart: {e}")
-            self.conn.rollback()
     
     def remove_from_cart(self, cart_items):
         """Remove from cart"""
         pid = input("Enter product ID to remove: ").strip()
         try:
-            self.cursor.execute("""
-                DELETE FROM cart
-                WHERE cid = ? AND sessionNo = ? AND pid = ?
-            """, (self.current_user, self.session_no, pid))
-            
-            if self.cursor.rowcount > 0:
-                self.conn.commit()
-                print("Item removed from cart!")
-            else:
-                print("Product not in cart.")
-                
+            self.service.remove_from_cart(self.session, pid)
+            print("Item removed from cart!")
+        except ServiceError as e:
+            print(e)
         except sqlite3.Error as e:
             print(f"Error removing from cart: {e}")
-            self.conn.rollback()
     def checkout(self):
         """Process checkout"""
         print("\n--- CHECKOUT ---")
-        # Get items
         try:
-            self.cursor.execute("""
-                SELECT c.pid, p.name, p.price, c.qty, p.stock_count,
-                       (p.price * c.qty) as total
-                FROM cart c
-                JOIN products p ON c.pid = p.pid
-                WHERE c.cid = ? AND c.sessionNo = ?
-            """, (self.current_user, self.session_no))
-            
-            cart_items = self.cursor.fetchall()
-            if not cart_items:
+            #current prices and stock for the order summary
+            cart = self.service.cart(self.session, refresh=True)
+            if not cart.items:
                 print("Your cart is empty.")
                 return
             # Display order summary
-            print(f"\n{'PID':<6} {'Name':<30} {'Price':<10} {'Qty':<5} {'Total':<10}")
-            print("-" * 65)
-            grand_total = 0
-            for item in cart_items:
-                pid, name, price, qty, stock, total = item
-                print(f"{pid:<6} {name:<30} ${price:<9.2f} {qty:<5} ${total:<9.2f}")
-                grand_total += total
-            
-            print("-" * 65)
-            print(f"{'GRAND TOTAL:':<51} ${grand_total:.2f}")
+            self.display_cart(cart)
             # Get shipping address
             shipping_address = input("\nEnter shipping address: ").strip()
             
@@ -432,128 +294,87 @@ class ECommerceSystem:
             if confirm != 'y':
                 print("Order cancelled.")
                 return
-            self.create_order(cart_items, shipping_address)
+            self.create_order(shipping_address)
             
         except sqlite3.Error as e:
             print(f"Checkout error: {e}")
     
-    def create_order(self, cart_items, shipping_address):
+    def create_order(self, shipping_address):
         """new order"""
         try:
-            #Generate order number
-            self.cursor.execute("SELECT COALESCE(MAX(ono), 0) + 1 FROM orders")
-            ono = self.cursor.fetchone()[0]
-            
-            odate = datetime.now().strftime("%Y-%m-%d")
-            # Insert order
-            self.cursor.execute("""
-                INSERT INTO orders (ono, cid, sessionNo, odate, shipping_address)
-                VALUES (?, ?, ?, ?, ?)
-            """, (ono, self.current_user, self.session_no, odate, shipping_address))
-            line_no = 1
-            for item in cart_items:
-                pid, name, price, qty, stock, total = item
-                # Insert order line
-                self.cursor.execute("""
-                    INSERT INTO orderlines (ono, lineNo, pid, qty, uprice)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (ono, line_no, pid, qty, price))
-                #Update stock
-                self.cursor.execute("""
-                    UPDATE products
-                    SET stock_count = stock_count - ?
-                    WHERE pid = ?
-                """, (qty, pid))
-                line_no += 1
-            
-            #Clear cart
-            self.cursor.execute("""
-                DELETE FROM cart
-                WHERE cid = ? AND sessionNo = ?
-            """, (self.current_user, self.session_no))
-            self.conn.commit()
+            ono = self.service.checkout(self.session, shipping_address)
             print(f"\nOrder placed successfully! Order number: {ono}")
-            
+        except ServiceError as e:
+            print(e)
         except sqlite3.Error as e:
             print(f"Error creating order: {e}")
-            self.conn.rollback()
     
     def view_orders(self):
         """View past orders"""
         print("\n--- MY ORDERS ---")
+        
+        def fetch_page(key, forward):
+            return self.service.orders(self.session, key, forward)
+        
         try:
-            self.cursor.execute("""
-                SELECT o.ono, o.odate, o.shipping_address,
-                       SUM(ol.qty * ol.uprice) as total
-                FROM orders o
-                JOIN orderlines ol ON o.ono = ol.ono
-                WHERE o.cid = ?
-                GROUP BY o.ono, o.odate, o.shipping_address
-                ORDER BY o.odate DESC, o.ono DESC
-            """, (self.current_user,))
-            
-            orders = self.cursor.fetchall()
-            
-            if not orders:
+            first = fetch_page(None, True)
+            if not first.total:
                 print("No orders found.")
                 return
-            self.paginate_results(orders, self.display_order_row, 
-                                self.order_detail_view)
+            self.paginate_query(first, fetch_page, lambda o: (o[1], o[0]),
+                                self.display_order_row, self.order_detail_view)
         except sqlite3.Error as e:
             print(f"Error viewing orders: {e}")
     
+    def export_orders(self):
+        """Write all of the customer's orders to a CSV or JSONL file"""
+        print("\n--- EXPORT ORDER HISTORY ---")
+        path = input("File name (.csv or .jsonl): ").strip()
+        try:
+            fmt = catalog.file_format(path)
+            rows = self.service.export_orders(self.session)
+            with catalog.open_file(path, "w") as f:
+                count = catalog.write_records(f, fmt, ORDER_FIELDS, rows)
+            print(f"Exported {count} order lines to {path}.")
+        except ValueError:
+            print("Please use a file name ending in .csv or .jsonl.")
+        except OSError as e:
+            print(f"Cannot write {path}: {e}")
+        except sqlite3.Error as e:
+            print(f"Error exporting orders: {e}")
+    
     def display_order_row(self, order):
         """Display order row"""
         ono, odate, address, total = order
         print(f"  Order #{ono} | {odate} | {address[:30]:30} | ${total:.2f}")
     def order_detail_view(self, order):
         """Display order view"""
-        ono = order[0]
         try:
-            #order header
-            self.cursor.execute("""
-                SELECT ono, odate, shipping_address
-                FROM orders WHERE ono = ?
-            """, (ono,))
-            
-            header = self.cursor.fetchone()
-            if not header:
-                print("Order not found.")
-                return
-            ono, odate, address = header            
-            #order lines
-            self.cursor.execute("""
-                SELECT p.name, p.category, ol.qty, ol.uprice,
-                       (ol.qty * ol.uprice) as line_total
-                FROM orderlines ol
-                JOIN products p ON ol.pid = p.pid
-                WHERE ol.ono = ?
-                ORDER BY ol.lineNo
-            """, (ono,))
-            
-            lines = self.cursor.fetchall()
-            #Display order
-            print("\n" + "="*70)
-            print(f"Order Number: {ono}")
-            print(f"Order Date: {odate}")
-            print(f"Shipping Address: {address}")
-            print("="*70)
-            
-            print(f"\n{'Product':<30} {'Category':<15} {'Qty':<5} {'Price':<10} {'Total':<10}")
-            print("-" * 70)
-            grand_total = 0
-            for line in lines:
-                name, category, qty, uprice, line_total = line
-                print(f"{name:<30} {category:<15} {qty:<5} ${uprice:<9.2f} ${line_total:<9.2f}")
-                grand_total += line_total
-            
-            print("-" * 70)
-            print(f"{'GRAND TOTAL:':<60} ${grand_total:.2f}")
-            print("="*70)
-            input("\nPress Enter to continue...")
-            
+            header, lines = self.service.order_detail(self.session, order[0])
+        except ServiceError as e:
+            print(e)
+            return
         except sqlite3.Error as e:
             print(f"Error viewing order details: {e}")
+            return
+        ono, odate, address, order_total = header
+        #Display order
+        print("\n" + "="*70)
+        print(f"Order Number: {ono}")
+        print(f"Order Date: {odate}")
+        print(f"Shipping Address: {address}")
+        print("="*70)
+        
+        print(f"\n{'Product':<30} {'Category':<15} {'Qty':<5} {'Price':<10} {'Total':<10}")
+        print("-" * 70)
+        for line in lines:
+            name, category, qty, uprice, line_total = line
+            print(f"{name:<30} {category:<15} {qty:<5} ${uprice:<9.2f} ${line_total:<9.2f}")
+        
+        print("-" * 70)
+        print(f"{'GRAND TOTAL:':<60} ${order_total or 0:.2f}")
+        print("="*70)
+        input("\nPress Enter to continue...")
     
     def sales_menu(self):
         """Display salesperson menu"""
@@ -564,17 +385,30 @@ class ECommerceSystem:
             print("1. Check/Update Products")
             print("2. Sales Report")
             print("3. Top Selling Products")
-            print("4. Logout")
+            print("4. Product Views by Month")
+            print("5. Customer Search History")
+            print("6. Logout")
             print("="*50)
             
             choice = input("Enter your choice: ").strip()
             if choice == '1':
                 self.manage_products()
             elif choice == '2':
-                self.sales_report()
+                days = input("Report window in days (default 7): ").strip()
+                if not days:
+                    self.sales_report()
+                elif days.isdigit() and int(days) > 0:
+                    self.sales_report(int(days))
+                else:
+                    print("Invalid number of days.")
             elif choice == '3':
                 self.top_products()
             elif choice == '4':
+                self.views_by_month()
+            elif choice == '5':
+                self.search_history()
+            elif choice == '6':
+                self.end_session()
                 print("Logged out successfully.")
                 break
             else:
@@ -585,25 +419,10 @@ class ECommerceSystem:
         print("\n--- PRODUCT MANAGEMENT ---")
         pid = input("Enter product ID: ").strip()
         try:
-            self.cursor.execute("""
-                SELECT pid, name, category, price, stock_count, descr
-                FROM products WHERE pid = ?
-            """, (pid,))
-            
-            product = self.cursor.fetchone()
-            if not product:
-                print("Product not found.")
-                return
-            pid, name, category, price, stock, descr = product
-            
-            print("\n" + "="*60)
-            print(f"Product ID: {pid}")
-            print(f"Name: {name}")
-            print(f"Category: {category}")
-            print(f"Price: ${price:.2f}")
-            print(f"Stock: {stock}")
-            print(f"Description: {descr}")
-            print("="*60)
+            product = self.service.product_info(self.session, pid)
+            self.display_product(product)
+            views, orders, units = self.service.popularity(self.session, pid)
+            print(f"Views: {views} | Orders: {orders} | Units sold: {units}")
 
             print("\n1. Update price")
             print("2. Update stock")
@@ -613,86 +432,39 @@ class ECommerceSystem:
             if choice == '1':
                 try:
                     new_price = float(input("Enter new price: ").strip())
-                    if new_price <= 0:
-                        print("Price must be positive.")
-                        return
-                    
-                    self.cursor.execute("""
-                        UPDATE products SET price = ? WHERE pid = ?
-                    """, (new_price, pid))
-                    self.conn.commit()
+                    self.service.update_price(self.session, pid, new_price)
                     print("Price updated successfully!")
-                    
                 except ValueError:
                     print("Invalid price.")
             elif choice == '2':
                 try:
                     new_stock = int(input("Enter new stock count: ").strip())
-                    if new_stock < 0:
-                        print("Stock must be non-negative.")
-                        return
-                    
-                    self.cursor.execute("""
-                        UPDATE products SET stock_count = ? WHERE pid = ?
-                    """, (new_stock, pid))
-                    self.conn.commit()
+                    self.service.update_stock(self.session, pid, new_stock)
                     print("Stock updated successfully!")
                 except ValueError:
                     print("Invalid stock count.")
-                    
+        except ServiceError as e:
+            print(e)
         except sqlite3.Error as e:
             print(f"Error managing products: {e}")
-            self.conn.rollback()
     
-    def sales_report(self):
-        """Generate weekly sales report"""
-        print("\n--- WEEKLY SALES REPORT ---")
-        print("Last 7 days")
-        seven_days_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
-        
+    def sales_report(self, days=7):
+        """Generate sales report"""
+        print("\n--- SALES REPORT ---" if days != 7 else "\n--- WEEKLY SALES REPORT ---")
+        print(f"Last {days} days")
         try:
-            # distinct orders
-            self.cursor.execute("""
-                SELECT COUNT(DISTINCT ono)
-                FROM orders
-                WHERE odate >= ?
-            """, (seven_days_ago,))
-            num_orders = self.cursor.fetchone()[0]
-            
-            #Number of distinct products sold
-            self.cursor.execute("""
-                SELECT COUNT(DISTINCT ol.pid)
-                FROM orders o
-                JOIN orderlines ol ON o.ono = ol.ono
-                WHERE o.odate >= ?
-            """, (seven_days_ago,))
-            num_products = self.cursor.fetchone()[0]
-            #distinct customers
-            self.cursor.execute("""
-                SELECT COUNT(DISTINCT cid)
-                FROM orders
-                WHERE odate >= ?
-            """, (seven_days_ago,))
-            num_customers = self.cursor.fetchone()[0]
-            # sales amount
-            self.cursor.execute("""
-                SELECT COALESCE(SUM(ol.qty * ol.uprice), 0)
-                FROM orders o
-                JOIN orderlines ol ON o.ono = ol.ono
-                WHERE o.odate >= ?
-            """, (seven_days_ago,))
-            total_sales = self.cursor.fetchone()[0]
-            avg_per_customer = total_sales / num_customers if num_customers > 0 else 0
-            
+            report = self.service.sales_report(self.session, days)
             print("\n" + "="*50)
-            print(f"Number of Orders:       {num_orders}")
-            print(f"Products Sold:          {num_products}")
-            print(f"Customers:              {num_customers}")
-            print(f"Total Sales:            ${total_sales:.2f}")
-            print(f"Average per Customer:   ${avg_per_customer:.2f}")
+            print(f"Number of Orders:       {report['orders']}")
+            print(f"Products Sold:          {report['products']}")
+            print(f"Customers:              {report['customers']}")
+            print(f"Total Sales:            ${report['total_sales']:.2f}")
+            print(f"Average per Customer:   ${report['avg_per_customer']:.2f}")
             print("="*50)
             input("\nPress Enter to continue...")
             
+        except ServiceError as e:
+            print(e)
         except sqlite3.Error as e:
             print(f"Error generating report: {e}")
     
@@ -700,93 +472,77 @@ class ECommerceSystem:
         """top-selling products"""
         print("\n--- TOP SELLING PRODUCTS ---")
         try:
-            print("\nTop 3 Products by Orders:")
-            print("-" * 60)
-            
-            self.cursor.execute("""
-                SELECT p.pid, p.name, COUNT(DISTINCT ol.ono) as order_count
-                FROM products p
-                JOIN orderlines ol ON p.pid = ol.pid
-                GROUP BY p.pid, p.name
-                ORDER BY order_count DESC
-                LIMIT 3
-            """)
-            top_by_orders = self.cursor.fetchall()
-            if not top_by_orders:
-                print("No data available.")
-            else:
-                #ties at position 3
-                if len(top_by_orders) == 3:
-                    third_count = top_by_orders[2][2]
-                    # Get all products with same count as 3rd place
-                    self.cursor.execute("""
-                        SELECT p.pid, p.name, COUNT(DISTINCT ol.ono) as order_count
-                        FROM products p
-                        JOIN orderlines ol ON p.pid = ol.pid
-                        GROUP BY p.pid, p.name
-                        HAVING order_count >= ?
-                        ORDER BY order_count DESC
-                    """, (third_count,))
-                    
-                    top_by_orders = self.cursor.fetchall()
-                rank = 1
-                for pid, name, count in top_by_orders:
-                    print(f"{rank}. {name} (PID: {pid}) - {count} orders")
-                    rank += 1
-            print("\nTop 3 Products by Views:")
-            print("-" * 60)
-            
-            self.cursor.execute("""
-                SELECT p.pid, p.name, COUNT(*) as view_count
-                FROM products p
-                JOIN viewedProduct v ON p.pid = v.pid
-                GROUP BY p.pid, p.name
-                ORDER BY view_count DESC
-                LIMIT 3
-            """)
-            
-            top_by_views = self.cursor.fetchall()
-            
-            if not top_by_views:
-                print("No data available.")
-            else:
-                #ties at position 3
-                if len(top_by_views) == 3:
-                    third_count = top_by_views[2][2]
-                    
-                    self.cursor.execute("""
-                        SELECT p.pid, p.name, COUNT(*) as view_count
-                        FROM products p
-                        JOIN viewedProduct v ON p.pid = v.pid
-                        GROUP BY p.pid, p.name
-                        HAVING view_count >= ?
-                        ORDER BY view_count DESC
-                    """, (third_count,))
-                    
-                    top_by_views = self.cursor.fetchall()
-                
+            top_n = self.service.top_n
+            boards = self.service.top_products(self.session, top_n)
+            for kind, label in (("orders", "Orders"), ("views", "Views")):
+                print(f"\nTop {top_n} Products by {label}:")
+                print("-" * 60)
+                if not boards[kind]:
+                    print("No data available.")
+                    continue
                 rank = 1
-                for pid, name, count in top_by_views:
-                    print(f"{rank}. {name} (PID: {pid}) - {count} views")
+                for pid, name, count in boards[kind]:
+                    print(f"{rank}. {name} (PID: {pid}) - {count} {kind}")
                     rank += 1
             input("\nPress Enter to continue...")
             
+        except ServiceError as e:
+            print(e)
         except sqlite3.Error as e:
             print(f"Error fetching top products: {e}")
     
-    def paginate_results(self, results, display_func, detail_func):
-        """Generic pagination for results"""
+    def views_by_month(self):
+        """Monthly view counts for one product"""
+        print("\n--- PRODUCT VIEWS BY MONTH ---")
+        pid = input("Enter product ID: ").strip()
+        include_archive = input("Include archived months? (y/n): ").strip().lower() == 'y'
+        try:
+            months = self.service.views_by_month(self.session, pid, include_archive)
+            if not months:
+                print("No views recorded.")
+                return
+            print(f"{'Month':<10} {'Views':>8}")
+            print("-" * 19)
+            for month, views in months:
+                print(f"{month:<10} {views:>8}")
+            input("\nPress Enter to continue...")
+        except sqlite3.Error as e:
+            print(f"Error fetching views: {e}")
+
+    def search_history(self):
+        """Everything one customer searched for"""
+        print("\n--- CUSTOMER SEARCH HISTORY ---")
+        cid = input("Enter customer ID: ").strip()
+        include_archive = input("Include archived months? (y/n): ").strip().lower() == 'y'
+        try:
+            searches = self.service.search_history(self.session, cid, include_archive)
+            if not searches:
+                print("No searches recorded.")
+                return
+            print(f"{'Session':>7}  {'Time':<19}  Query")
+            print("-" * 50)
+            for session_no, ts, query in searches:
+                print(f"{session_no:>7}  {ts[:19]:<19}  {query}")
+            input("\nPress Enter to continue...")
+        except sqlite3.Error as e:
+            print(f"Error fetching search history: {e}")
+
+    def paginate_query(self, first, fetch_page, key_func, display_func, detail_func):
+        """Keyset pagination, only the current page is held in memory
+        
+        first is the first Page; fetch_page(key, forward) returns the page
+        after key (forward) or before it; key_func gives a row's sort key.
+        """
         page = 0
-        page_size = 5
-        total_pages = (len(results) + page_size - 1) // page_size
+        total_pages = (first.total + PAGE_SIZE - 1) // PAGE_SIZE
+        rows = first.rows
         while True:
-            start = page * page_size
-            end = min(start + page_size, len(results))
+            start = page * PAGE_SIZE
             
             print(f"\nPage {page + 1} of {total_pages}")
             print("-" * 70)
             
-            for i, result in enumerate(results[start:end], start=1):
+            for i, result in enumerate(rows, start=1):
                 print(f"{start + i}.", end=" ")
                 display_func(result)
             
@@ -796,15 +552,19 @@ class ECommerceSystem:
             choice = input("Enter choice: ").strip().lower()
             
             if choice == 'n' and page < total_pages - 1:
-                page += 1
+                next_rows = fetch_page(key_func(rows[-1]), True).rows
+                if next_rows:
+                    rows = next_rows
+                    page += 1
             elif choice == 'p' and page > 0:
+                rows = fetch_page(key_func(rows[0]), False).rows
                 page -= 1
             elif choice == 'b':
                 break
             elif choice.isdigit():
-                idx = int(choice) - 1
-                if 0 <= idx < len(results):
-                    detail_func(results[idx])
+                idx = int(choice) - 1 - start
+                if 0 <= idx < len(rows):
+                    detail_func(rows[idx])
                 else:
                     print("Invalid selection.")
             else:
@@ -818,24 +578,156 @@ class ECommerceSystem:
                 if not self.login_screen():
                     break
                 
-                if self.current_role == 'customer':
+                if self.session.role == 'customer':
                     self.customer_menu()
-                elif self.current_role == 'sales':
+                elif self.session.role == 'sales':
                     self.sales_menu()
                 #Reset user
-                self.current_user = None
-                self.current_role = None
-                self.session_no = None
+                self.session = None
                 
         finally:
             self.close()
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: python main.py <database_file>")
+    parser = argparse.ArgumentParser(description="E-commerce system")
+    parser.add_argument("database_file")
+    parser.add_argument("--rebuild-search-index", action="store_true",
+                        help="rebuild the product search index and exit")
+    parser.add_argument("--reconcile-popularity", action="store_true",
+                        help="rebuild the product popularity counters from history and exit")
+    parser.add_argument("--search-top-k", type=int, default=100,
+                        help="best match search pages through this many top matches (default 100)")
+    parser.add_argument("--rank-popularity", type=float, default=0.0,
+                        help="weight of units sold in best match scores (default 0, off)")
+    parser.add_argument("--top-n", type=int, default=3,
+                        help="number of products on the top products screen (default 3)")
+    parser.add_argument("--leaderboard-ttl", type=float, default=0,
+                        help="cache top products counts for this many seconds (default off)")
+    parser.add_argument("--product-cache-ttl", type=float, default=5,
+                        help="seconds a cached product row is trusted (default 5, 0 = no cache)")
+    parser.add_argument("--product-cache-size", type=int, default=1000,
+                        help="product rows kept in the cache (default 1000)")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="default",
+                        help="connection profile; use 'concurrent' (WAL) when several "
+                             "processes share the database file")
+    parser.add_argument("--config", help="INI file with a [connection] section")
+    parser.add_argument("--journal-mode")
+    parser.add_argument("--busy-timeout", type=int, help="milliseconds")
+    parser.add_argument("--synchronous")
+    parser.add_argument("--mmap-size", type=int, help="bytes")
+    parser.add_argument("--cache-size", type=int, help="pages, or KiB if negative")
+    parser.add_argument("--archive", action="store_true",
+                        help="move old views, searches and sessions to monthly archive databases and exit")
+    parser.add_argument("--retention-days", type=int, default=90,
+                        help="history kept in the main database by --archive (default 90)")
+    parser.add_argument("--archive-dir", help="where archive databases go (default: next to the database)")
+    parser.add_argument("--check-plans", action="store_true",
+                        help="report hot queries that fall back to full table scans and exit")
+    parser.add_argument("--password-scheme", choices=SCHEMES, default="pbkdf2_sha256",
+                        help="hash for new and rehashed passwords (default pbkdf2_sha256)")
+    parser.add_argument("--password-cost", type=int,
+                        help="pbkdf2 iterations or scrypt log2(n) (defaults: "
+                             + ", ".join(f"{k} {v}" for k, v in DEFAULT_COST.items()) + ")")
+    parser.add_argument("--login-cache", type=int, default=0,
+                        help="remember this many recently verified logins for 5 minutes (default off)")
+    parser.add_argument("--report-workers", type=int, default=0,
+                        help="run report queries side by side on this many read-only connections (default off)")
+    parser.add_argument("--report-timeout", type=float,
+                        help="give up on a report after this many seconds (with --report-workers)")
+    parser.add_argument("--profile-queries", nargs="?", const="-", metavar="FILE",
+                        help="time every statement and print per-statement latency histograms "
+                             "on exit (to FILE if given; send SIGUSR1 for a dump while running)")
+    parser.add_argument("--slow-log", metavar="FILE",
+                        help="append statements slower than --slow-ms to FILE with their query plan")
+    parser.add_argument("--slow-ms", type=float, default=100,
+                        help="slow query threshold in milliseconds (default 100)")
+    parser.add_argument("--slow-log-params", action="store_true",
+                        help="write parameter values to the slow log, not just their types "
+                             "(they include password hashes and emails)")
+    parser.add_argument("--query-stats", action="store_true",
+                        help="print prepared statement cache hits/misses on exit (approximate)")
+    args = parser.parse_args()
+    try:
+        settings = load_profile(args.profile, args.config, {
+            "journal_mode": args.journal_mode,
+            "busy_timeout": args.busy_timeout,
+            "synchronous": args.synchronous,
+            "mmap_size": args.mmap_size,
+            "cache_size": args.cache_size,
+        })
+    except (ValueError, KeyError) as e:
+        print(f"Invalid connection settings: {e}")
         sys.exit(1)
     
-    db_name = sys.argv[1]
-    system = ECommerceSystem(db_name)
-    system.run()
+    hasher = PasswordHasher(args.password_scheme, args.password_cost, cache_size=args.login_cache)
+    reports = (ReportEngine(args.database_file, args.report_workers, args.report_timeout, settings)
+               if args.report_workers > 0 else None)
+    instrumentation = None
+    if args.profile_queries or args.slow_log:
+        instrumentation = Instrumentation(args.slow_ms, args.slow_log, args.profile_queries,
+                                          args.slow_log_params)
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: instrumentation.dump(sys.stderr))
+    system = ECommerceSystem(args.database_file, top_n=args.top_n,
+                             leaderboard_ttl=args.leaderboard_ttl,
+                             product_cache_ttl=args.product_cache_ttl,
+                             product_cache_size=args.product_cache_size,
+                             connection_settings=settings,
+                             password_hasher=hasher, report_engine=reports,
+                             instrumentation=instrumentation,
+                             search_top_k=args.search_top_k,
+                             rank_popularity=args.rank_popularity,
+                             archive_dir=args.archive_dir)
+    #the one-off modes return early; the profile dump and slow log are
+    #written whichever way main() ends
+    try:
+        if args.rebuild_search_index:
+            system.connect()
+            try:
+                system.service.rebuild_search_index()
+                print("Search index rebuilt.")
+            finally:
+                system.close()
+            return
+        if args.reconcile_popularity:
+            system.connect()
+            try:
+                drifted = system.service.reconcile_popularity()
+                print(f"Popularity counters rebuilt ({drifted} products had drifted).")
+            except sqlite3.Error as e:
+                print(f"Reconcile error: {e}")
+                sys.exit(1)
+            finally:
+                system.close()
+            return
+        if args.archive:
+            system.connect()
+            try:
+                moved = system.service.archive_history(args.retention_days)
+                for table, count in moved.items():
+                    print(f"Archived {count} {table} rows")
+            except sqlite3.Error as e:
+                print(f"Archive error: {e}")
+                sys.exit(1)
+            finally:
+                system.close()
+            return
+        if args.check_plans:
+            system.connect()
+            try:
+                ok = system.check_query_plans()
+            finally:
+                system.close()
+            sys.exit(0 if ok else 1)
+        system.run()
+    finally:
+        if reports is not None:
+            reports.close()
+        if instrumentation is not None:
+            instrumentation.close()
+    if args.query_stats:
+        stats = system.service.queries.stats()
+        print(f"Statement cache (service connection, approximate): {stats['hits']} hits, {stats['misses']} misses "
+              f"({stats['hit_rate']:.0%}), {stats['statements']} statements, "
+              f"capacity {stats['capacity']}")
 if __name__ == "__main__":
     main()
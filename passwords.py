@@ -0,0 +1,126 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Passwords are stored in users.pwd as "scheme$params$salt$hash" (salt and
+# hash base64), so every row carries its own algorithm and cost:
+#   pbkdf2_sha256$600000$<salt>$<hash>
+#   scrypt$14:8:1$<salt>$<hash>        (log2 n : r : p)
+# Rows from before this (a bare SHA-256 hex digest) are "sha256" and are
+# rehashed with the current scheme the next time the user logs in.
+SCHEMES = ("pbkdf2_sha256", "scrypt")
+DEFAULT_COST = {
+    "pbkdf2_sha256": 600000,  # iterations
+    "scrypt": 14,  # log2 of n, with r=8, p=1 (16 MiB)
+}
+SALT_BYTES = 16
+
+
+def b64(data):
+    return base64.b64encode(data).decode()
+
+
+def derive(scheme, params, password, salt):
+    """Raw hash of password for one scheme and its params string"""
+    if scheme == "sha256":
+        return hashlib.sha256(password.encode()).hexdigest().encode()
+    if scheme == "pbkdf2_sha256":
+        return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, int(params))
+    if scheme == "scrypt":
+        log_n, r, p = (int(x) for x in params.split(":"))
+        n = 1 << log_n
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                              maxmem=128 * r * (n + p + 2))
+    raise ValueError(f"Unknown password scheme: {scheme}")
+
+
+def parse(encoded):
+    """(scheme, params, salt, hash) of a stored password"""
+    if "$" not in encoded:
+        return "sha256", "", b"", encoded.encode()
+    scheme, params, salt, digest = encoded.split("$")
+    return scheme, params, base64.b64decode(salt), base64.b64decode(digest)
+
+
+class PasswordHasher:
+    """Hashes new passwords with one configured scheme/cost and verifies any
+    stored format
+
+    The KDFs release the GIL, so verification runs on a small thread pool:
+    submit() lets a server keep serving other requests while a login is
+    checked, verify() waits for the result. With cache_size > 0, recently
+    verified (stored hash, password) pairs are remembered for cache_ttl
+    seconds, keyed by an HMAC under a per-process random key so plain
+    passwords are never kept in memory.
+    """
+    def __init__(self, scheme="pbkdf2_sha256", cost=None, workers=None, cache_size=0, cache_ttl=300):
+        if scheme not in SCHEMES:
+            raise ValueError(f"Unknown password scheme: {scheme}")
+        self.scheme = scheme
+        cost = DEFAULT_COST[scheme] if cost is None else cost
+        self.params = str(cost) if scheme == "pbkdf2_sha256" else f"{cost}:8:1"
+        self.pool = ThreadPoolExecutor(workers or os.cpu_count() or 1,
+                                       thread_name_prefix="password")
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.cache_key = os.urandom(32)
+        self.dummy = None
+
+    def hash(self, password):
+        salt = os.urandom(SALT_BYTES)
+        return f"{self.scheme}${self.params}${b64(salt)}${b64(derive(self.scheme, self.params, password, salt))}"
+
+    def check(self, password, encoded):
+        """Compare password with a stored hash (runs on the calling thread)"""
+        key = None
+        if self.cache_size:
+            key = hmac.new(self.cache_key, f"{encoded}\0{password}".encode(), "sha256").digest()
+            with self.cache_lock:
+                verified_at = self.cache.get(key)
+                if verified_at is not None and time.monotonic() - verified_at <= self.cache_ttl:
+                    self.cache.move_to_end(key)
+                    return True
+        try:
+            scheme, params, salt, digest = parse(encoded)
+            ok = hmac.compare_digest(derive(scheme, params, password, salt), digest)
+        except (ValueError, TypeError):
+            return False
+        if ok and key is not None:
+            with self.cache_lock:
+                self.cache[key] = time.monotonic()
+                self.cache.move_to_end(key)
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return ok
+
+    def submit(self, password, encoded):
+        """Future for check() on the worker pool"""
+        if encoded is None:
+            #unknown users cost as much as a wrong password
+            if self.dummy is None:
+                self.dummy = self.hash("")
+            encoded = self.dummy
+        return self.pool.submit(self.check, password, encoded)
+
+    def submit_hash(self, password):
+        """Future for hash() on the worker pool"""
+        return self.pool.submit(self.hash, password)
+
+    def verify(self, password, encoded):
+        """check() on the worker pool; encoded None (no such user) is always False"""
+        ok = self.submit(password, encoded).result()
+        return ok and encoded is not None
+
+    def needs_rehash(self, encoded):
+        scheme, params, _, _ = parse(encoded)
+        return scheme != self.scheme or params != self.params
+
+    def close(self):
+        self.pool.shutdown(wait=False)
@@ -1,3 +1,9 @@
+PRAGMA user_version = 0;
+DROP TABLE IF EXISTS products_fts;
+DROP TABLE IF EXISTS sales_daily;
+DROP TABLE IF EXISTS id_sequences;
+DROP TABLE IF EXISTS view_counts_archived;
+DROP TABLE IF EXISTS product_popularity;
 DROP TABLE IF EXISTS cart;
 DROP TABLE IF EXISTS search;
 DROP TABLE IF EXISTS viewedProduct;
@@ -0,0 +1,476 @@
+import sqlite3
+
+# Every statement ECommerceService runs, defined once.
+#
+# sqlite3 keeps up to cached_statements prepared statements per connection in
+# an LRU keyed on the exact SQL text, so a statement is only parsed and
+# planned again if its text changes or it was evicted. Static statements are
+# plain strings; the ones that depend on the request (search keywords, paging
+# direction) are built from a small fixed set of shapes, so the total number
+# of distinct texts is known and the cache can be sized to hold all of them.
+
+# trigram tokens are 3 characters, shorter keywords can't use the index
+MIN_INDEXED_KEYWORD = 3
+# short (LIKE) keyword counts are rounded up to one of these; unused slots get
+# '%' patterns, which match every product (name is NOT NULL)
+LIKE_BUCKETS = (1, 2, 4, 8)
+DIRECTIONS = ("first", "next", "prev")
+
+# product_popularity column each leaderboard ranks on; it is kept current by
+# triggers (schema.py), and views include the ones moved to the archive
+LEADERBOARDS = {
+    "orders": "orders",
+    "views": "views",
+}
+# search result orders: by (name, pid), best sellers first, or best match first
+SORTS = ("name", "popular", "relevance")
+
+# product_popularity recomputed from history: views (live and archived),
+# distinct orders and units sold per product
+POPULARITY_HISTORY = """
+    SELECT pid, SUM(views) AS views, SUM(orders) AS orders, SUM(units) AS units FROM (
+        SELECT pid, COUNT(*) AS views, 0 AS orders, 0 AS units
+        FROM viewedProduct GROUP BY pid
+        UNION ALL
+        SELECT pid, SUM(views), 0, 0 FROM view_counts_archived GROUP BY pid
+        UNION ALL
+        SELECT pid, 0, COUNT(DISTINCT ono), SUM(qty) FROM orderlines GROUP BY pid
+    ) GROUP BY pid
+"""
+
+STATEMENTS = {
+    # accounts and sessions
+    "user_credentials": """
+        SELECT uid, role, pwd FROM users
+        WHERE uid = ?
+    """,
+    "update_password": "UPDATE users SET pwd = ? WHERE uid = ?",
+    "end_session": """
+        UPDATE sessions
+        SET end_time = ?
+        WHERE cid = ? AND sessionNo = ?
+    """,
+    "next_session_no": """
+        UPDATE customers SET last_session = last_session + 1
+        WHERE cid = ?
+        RETURNING last_session
+    """,
+    "insert_session": """
+        INSERT INTO sessions (cid, sessionNo, start_time)
+        VALUES (?, ?, ?)
+    """,
+    "email_in_use": """
+        SELECT cid FROM customers WHERE email = ?
+    """,
+    "insert_user": """
+        INSERT INTO users (uid, pwd, role)
+        VALUES (?, ?, 'customer')
+    """,
+    "insert_customer": """
+        INSERT INTO customers (cid, name, email)
+        VALUES (?, ?, ?)
+    """,
+    "next_id": """
+        UPDATE id_sequences SET last_id = last_id + 1
+        WHERE name = ?
+        RETURNING last_id
+    """,
+    # products and cart
+    "product": """
+        SELECT pid, name, category, price, stock_count, descr
+        FROM products WHERE pid = ?
+    """,
+    "cart_lines": """
+        SELECT c.pid, p.name, p.price, c.qty, p.stock_count
+        FROM cart c
+        JOIN products p ON c.pid = p.pid
+        WHERE c.cid = ? AND c.sessionNo = ?
+    """,
+    "upsert_cart_item": """
+        INSERT INTO cart (cid, sessionNo, pid, qty)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (cid, sessionNo, pid) DO UPDATE SET qty = excluded.qty
+    """,
+    "delete_cart_item": """
+        DELETE FROM cart
+        WHERE cid = ? AND sessionNo = ? AND pid = ?
+    """,
+    "clear_cart": """
+        DELETE FROM cart
+        WHERE cid = ? AND sessionNo = ?
+    """,
+    # checkout
+    "insert_order": """
+        INSERT INTO orders (ono, cid, sessionNo, odate, shipping_address)
+        VALUES (NULL, ?, ?, ?, ?)
+    """,
+    "insert_orderlines": """
+        INSERT INTO orderlines (ono, lineNo, pid, qty, uprice)
+        SELECT ?, ROW_NUMBER() OVER (ORDER BY c.pid), c.pid, c.qty, p.price
+        FROM cart c
+        JOIN products p ON c.pid = p.pid
+        WHERE c.cid = ? AND c.sessionNo = ?
+    """,
+    #lines short on stock are skipped, the caller compares rowcounts
+    "take_stock": """
+        UPDATE products AS p
+        SET stock_count = p.stock_count - c.qty
+        FROM cart c
+        WHERE c.pid = p.pid AND c.cid = ? AND c.sessionNo = ?
+          AND p.stock_count >= c.qty
+    """,
+    "ordered_products": """
+        SELECT ol.pid, p.name FROM orderlines ol
+        JOIN products p ON ol.pid = p.pid
+        WHERE ol.ono = ?
+    """,
+    #customers/products only count if not already seen earlier that day
+    "record_daily_sales": """
+        INSERT INTO sales_daily (day, orders, revenue, customers, products)
+        SELECT o.odate, 1,
+               (SELECT COALESCE(SUM(ol.qty * ol.uprice), 0)
+                FROM orderlines ol WHERE ol.ono = o.ono),
+               NOT EXISTS (SELECT 1 FROM orders prev
+                           WHERE prev.cid = o.cid AND prev.odate = o.odate
+                             AND prev.ono <> o.ono),
+               (SELECT COUNT(DISTINCT ol.pid) FROM orderlines ol
+                WHERE ol.ono = o.ono AND NOT EXISTS (
+                    SELECT 1 FROM orders prev
+                    JOIN orderlines pl ON pl.ono = prev.ono
+                    WHERE prev.odate = o.odate AND prev.ono <> o.ono
+                      AND pl.pid = ol.pid))
+        FROM orders o
+        WHERE o.ono = ?
+        ON CONFLICT (day) DO UPDATE SET
+            orders = orders + excluded.orders,
+            revenue = revenue + excluded.revenue,
+            customers = customers + excluded.customers,
+            products = products + excluded.products
+    """,
+    "set_order_total": """
+        UPDATE orders
+        SET total = (SELECT SUM(ol.qty * ol.uprice) FROM orderlines ol WHERE ol.ono = orders.ono)
+        WHERE ono = ?
+    """,
+    # order history
+    "orders_count": """
+        SELECT COUNT(*) FROM orders
+        WHERE cid = ? AND total IS NOT NULL
+    """,
+    #header columns repeat on every line; an order without lines has one row of NULL lines
+    "order_detail": """
+        SELECT o.ono, o.odate, o.shipping_address, o.total,
+               p.name, p.category, ol.qty, ol.uprice, (ol.qty * ol.uprice) as line_total
+        FROM orders o
+        LEFT JOIN orderlines ol ON ol.ono = o.ono
+        LEFT JOIN products p ON ol.pid = p.pid
+        WHERE o.ono = ? AND o.cid = ?
+        ORDER BY ol.lineNo
+    """,
+    #one row per order line (ORDER_FIELDS), newest order first
+    "order_history": """
+        SELECT o.ono, o.odate, o.shipping_address, o.total,
+               ol.lineNo, ol.pid, p.name, ol.qty, ol.uprice, (ol.qty * ol.uprice)
+        FROM orders o
+        JOIN orderlines ol ON ol.ono = o.ono
+        JOIN products p ON ol.pid = p.pid
+        WHERE o.cid = ?
+        ORDER BY o.odate DESC, o.ono DESC, ol.lineNo
+    """,
+    # sales staff
+    "update_price": "UPDATE products SET price = ? WHERE pid = ?",
+    "update_stock": "UPDATE products SET stock_count = ? WHERE pid = ?",
+    "sales_rollup": """
+        SELECT COALESCE(SUM(orders), 0), COALESCE(SUM(revenue), 0),
+               COALESCE(SUM(customers), 0), COALESCE(SUM(products), 0)
+        FROM sales_daily
+        WHERE day BETWEEN ? AND ?
+    """,
+    "sales_distinct": """
+        WITH window_orders AS (
+            SELECT ono, cid FROM orders WHERE odate BETWEEN ? AND ?
+        )
+        SELECT (SELECT COUNT(DISTINCT cid) FROM window_orders),
+               (SELECT COUNT(DISTINCT ol.pid)
+                FROM window_orders w JOIN orderlines ol ON ol.ono = w.ono)
+    """,
+    "views_by_month": """
+        SELECT substr(ts, 1, 7) AS month, COUNT(*)
+        FROM viewedProduct WHERE pid = ?
+        GROUP BY month
+    """,
+    "archived_views_by_month": """
+        SELECT month, views FROM view_counts_archived WHERE pid = ?
+    """,
+    "search_history": """
+        SELECT sessionNo, ts, query FROM search WHERE cid = ? ORDER BY ts
+    """,
+    "rebuild_search_index": "INSERT INTO products_fts (products_fts) VALUES ('rebuild')",
+    #products whose counters differ from their history
+    "popularity_drift": f"""
+        SELECT COUNT(DISTINCT pid) FROM (
+            SELECT pid FROM (
+                SELECT pid, views, orders, units FROM ({POPULARITY_HISTORY})
+                EXCEPT
+                SELECT pid, views, orders, units FROM product_popularity
+            )
+            UNION ALL
+            SELECT pid FROM (
+                SELECT pid, views, orders, units FROM product_popularity
+                WHERE views > 0 OR orders > 0 OR units > 0
+                EXCEPT
+                SELECT pid, views, orders, units FROM ({POPULARITY_HISTORY})
+            )
+        )
+    """,
+    "clear_popularity": "DELETE FROM product_popularity",
+    "rebuild_popularity": f"""
+        INSERT INTO product_popularity (pid, views, orders, units)
+        SELECT pid, views, orders, units FROM ({POPULARITY_HISTORY})
+    """,
+    "popularity": """
+        SELECT views, orders, units FROM product_popularity WHERE pid = ?
+    """,
+}
+
+for kind, column in LEADERBOARDS.items():
+    #all counts, for the leaderboard cache to rank itself
+    STATEMENTS[f"{kind}_counts"] = f"""
+        SELECT pp.pid, p.name, pp.{column}
+        FROM product_popularity pp
+        JOIN products p ON p.pid = pp.pid
+        WHERE pp.{column} > 0
+    """
+    #top n with ties at position n: everything at least the n-th highest count
+    #(an index range on the counter instead of ranking every product)
+    STATEMENTS[f"top_{kind}"] = f"""
+        SELECT pp.pid, p.name, pp.{column}
+        FROM product_popularity pp
+        JOIN products p ON p.pid = pp.pid
+        WHERE pp.{column} >= COALESCE(
+            (SELECT {column} FROM product_popularity WHERE {column} > 0
+             ORDER BY {column} DESC LIMIT 1 OFFSET ? - 1), 1)
+        ORDER BY pp.{column} DESC, pp.pid
+    """
+
+
+def keyset_clause(columns, key, forward, descending=False):
+    """Seek predicate and ORDER BY for the page after (or before) key"""
+    ascending = forward != descending
+    order = ", ".join(f"{c} {'ASC' if ascending else 'DESC'}" for c in columns)
+    if key is None:
+        return "1", order, []
+    placeholders = ", ".join("?" * len(columns))
+    seek = f"({', '.join(columns)}) {'>' if ascending else '<'} ({placeholders})"
+    return seek, order, list(key)
+
+
+def direction(key, forward):
+    """Paging shape: the first page, or the page after/before key"""
+    if key is None:
+        return "first"
+    return "next" if forward else "prev"
+
+
+def like_slots(count):
+    """Number of LIKE conditions a search with count short keywords is padded to"""
+    if count == 0:
+        return 0
+    for bucket in LIKE_BUCKETS:
+        if count <= bucket:
+            return bucket
+    top = LIKE_BUCKETS[-1]
+    return -(-count // top) * top
+
+
+def search_sql(count, indexed, likes, paging="first", sort="name"):
+    """COUNT (count=True) or page query for a search shape: whether there is a
+    MATCH on the trigram index, how many LIKE slots, the paging direction and
+    the sort ("popular" adds units sold as a sixth column)"""
+    conditions = []
+    if indexed:
+        conditions.append("products.rowid IN (SELECT rowid FROM products_fts WHERE products_fts MATCH ?)")
+    conditions += ["(LOWER(products.name) LIKE ? OR LOWER(products.descr) LIKE ?)"] * likes
+    where_clause = " AND ".join(conditions)
+    if count:
+        return f"SELECT COUNT(*) FROM products WHERE {where_clause}"
+    key = None if paging == "first" else ()
+    if sort == "popular":
+        seek, order, _ = keyset_clause(("COALESCE(pp.units, 0)", "products.pid"), key,
+                                       paging != "prev", descending=True)
+        return f"""
+            SELECT products.pid, products.name, products.category, products.price,
+                   products.stock_count, COALESCE(pp.units, 0)
+            FROM products
+            LEFT JOIN product_popularity pp ON pp.pid = products.pid
+            WHERE {where_clause} AND {seek}
+            ORDER BY {order}
+            LIMIT ?
+        """
+    seek, order, _ = keyset_clause(("name", "pid"), key, paging != "prev")
+    return f"""
+        SELECT pid, name, category, price, stock_count
+        FROM products
+        WHERE {where_clause} AND {seek}
+        ORDER BY {order}
+        LIMIT ?
+    """
+
+
+def ranked_sql(indexed, likes, popularity):
+    """Matches with a relevance score, best first, for one page (LIMIT ? OFFSET ?)
+
+    Keywords on the trigram index are scored with bm25 (name and descr
+    weights bound as the first two parameters), each LIKE slot adds its name
+    and descr weights when it hits, and popularity adds up to its weight for
+    units sold. SQLite's sorter keeps only LIMIT + OFFSET rows for an ORDER BY
+    with a LIMIT, so memory is bounded by the page depth, not the match count.
+    """
+    terms = ["-bm25(products_fts, ?, ?)"] if indexed else []
+    #descr can be NULL, and a NULL term would make the whole score NULL
+    terms += ["(LOWER(products.name) LIKE ?) * ? + COALESCE(LOWER(products.descr) LIKE ?, 0) * ?"] * likes
+    tables = "products_fts JOIN products ON products.rowid = products_fts.rowid" if indexed else "products"
+    if popularity:
+        terms.append("? * COALESCE(pp.units, 0) / (COALESCE(pp.units, 0) + 10.0)")
+        tables += " LEFT JOIN product_popularity pp ON pp.pid = products.pid"
+    conditions = ["products_fts MATCH ?"] if indexed else []
+    conditions += ["(LOWER(products.name) LIKE ? OR LOWER(products.descr) LIKE ?)"] * likes
+    return f"""
+        SELECT products.pid, products.name, products.category, products.price,
+               products.stock_count, {" + ".join(terms)} AS score
+        FROM {tables}
+        WHERE {" AND ".join(conditions)}
+        ORDER BY score DESC, products.pid
+        LIMIT ? OFFSET ?
+    """
+
+
+def orders_sql(paging="first"):
+    """One page of a customer's orders, newest first, with their stored totals"""
+    seek, order, _ = keyset_clause(("odate", "ono"), None if paging == "first" else (),
+                                   paging != "prev", descending=True)
+    return f"""
+        SELECT ono, odate, shipping_address, total
+        FROM orders
+        WHERE cid = ? AND total IS NOT NULL AND {seek}
+        ORDER BY {order}
+        LIMIT ?
+    """
+
+
+BUILDERS = {
+    "search": search_sql,
+    "ranked_search": ranked_sql,
+    "orders_page": orders_sql,
+}
+
+
+def shapes():
+    """Every (name, shape) the service can run"""
+    for name in STATEMENTS:
+        yield name, ()
+    for count in (True, False):
+        for indexed in (True, False):
+            for likes in (0,) + LIKE_BUCKETS:
+                if not indexed and not likes:
+                    continue
+                if count:
+                    yield "search", (count, indexed, likes, "first")
+                    continue
+                for paging in DIRECTIONS:
+                    for sort in SORTS:
+                        yield "search", (count, indexed, likes, paging, sort)
+    for indexed in (True, False):
+        for likes in (0,) + LIKE_BUCKETS:
+            if indexed or likes:
+                for popularity in (False, True):
+                    yield "ranked_search", (indexed, likes, popularity)
+    for paging in DIRECTIONS:
+        yield "orders_page", (paging,)
+
+
+# room for every shape plus the statements run outside the registry (event
+# and catalog inserts, pragmas, migrations, plan checks)
+CACHE_SIZE = max(128, len(list(shapes())) + 32)
+
+
+class QueryRegistry:
+    """SQL text by statement name and shape, with statement cache statistics
+
+    Texts are built once per shape. The statistics are measured on the
+    connection given to attach(): SQLite only calls the authorizer while it
+    compiles a statement, so a statement run through run() that compiled
+    nothing came from sqlite3's statement cache (a hit) and one that did was
+    prepared (a miss). Only registry statements run on that connection are
+    counted; SQL compiled while one runs (FTS's internal statements, the slow
+    log's EXPLAIN) counts towards its miss.
+    """
+    def __init__(self, capacity=CACHE_SIZE):
+        self.capacity = capacity
+        self.texts = {}
+        self.compiled = 0
+        self.hits = 0
+        self.misses = 0
+
+    def sql(self, name, shape=()):
+        key = (name, shape)
+        text = self.texts.get(key)
+        if text is None:
+            text = STATEMENTS[name] if not shape else BUILDERS[name](*shape)
+            self.texts[key] = text
+        return text
+
+    def attach(self, conn):
+        conn.set_authorizer(self.authorize)
+
+    def authorize(self, action, *args):
+        #the sqlite3 module prepares its implicit BEGIN itself, every time
+        if action != sqlite3.SQLITE_TRANSACTION:
+            self.compiled += 1
+        return sqlite3.SQLITE_OK
+
+    def run(self, execute, text, params):
+        """execute(text, params), counted as a statement cache hit or miss"""
+        compiled = self.compiled
+        try:
+            return execute(text, params)
+        finally:
+            if self.compiled == compiled:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "statements": len(self.texts),
+            "capacity": self.capacity,
+        }
+
+
+# Representative hot queries with sample parameters, checked by check_query_plans
+HOT_QUERIES = {
+    "search_products (count)": (("search", (True, True, 0, "first")), ('"laptop"',)),
+    "search_products (page)": (("search", (False, True, 0, "next", "name")), ('"laptop"', '', '', 5)),
+    "search_products (ranked)": (("ranked_search", (True, 0, True)), (10.0, 1.0, 1.0, '"laptop"', 5, 0)),
+    "search_products (popular)": (("search", (False, True, 0, "next", "popular")), ('"laptop"', 0, '', 5)),
+    "product_detail_view": (("product", ()), ('P001',)),
+    "view_cart": (("cart_lines", ()), ('1', 1)),
+    "view_orders (count)": (("orders_count", ()), ('1',)),
+    "view_orders (page)": (("orders_page", ("next",)), ('1', '9999-12-31', 0, 5)),
+    "order_detail_view": (("order_detail", ()), (1, '1')),
+    "export_orders": (("order_history", ()), ('1',)),
+    "sales_report (rollup)": (("sales_rollup", ()), ('2000-01-01', '2000-01-07')),
+    "sales_report (distinct)": (("sales_distinct", ()), ('2000-01-01', '2000-01-07')),
+    "top_products (orders)": (("top_orders", ()), (3,)),
+    "top_products (views)": (("top_views", ()), (3,)),
+}
+
+
+def hot_queries():
+    """{display name: (sql, sample params)} for the plan checks"""
+    return {label: (STATEMENTS[name] if not shape else BUILDERS[name](*shape), params)
+            for label, ((name, shape), params) in HOT_QUERIES.items()}
@@ -0,0 +1,105 @@
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# SQLite VM instructions between checks for a timeout or cancel
+PROGRESS_STEPS = 1000
+
+
+class ReportCancelled(Exception):
+    """A report query ran past its deadline or was cancelled"""
+
+
+def read_only_uri(db_name):
+    """file: URI opening db_name read-only (mode=ro)"""
+    return pathlib.Path(os.path.abspath(db_name)).as_uri() + "?mode=ro"
+
+
+class ReportEngine:
+    """Runs report queries side by side on a pool of read-only connections
+
+    Each worker thread opens its own mode=ro connection, so a slow aggregation
+    never holds the interactive connection or a write lock. run() starts
+    every query of a report at once and waits for all of them; a progress
+    handler stops them after `timeout` seconds, when the caller sets its
+    cancel event, or as soon as one of them fails.
+    """
+    def __init__(self, db_name, workers=4, timeout=None, settings=None):
+        self.db_name = db_name
+        self.timeout = timeout
+        self.settings = settings or {}
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="report")
+
+    def connection(self):
+        """This worker thread's read-only connection, opened on first use"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(read_only_uri(self.db_name), uri=True,
+                                   timeout=self.settings.get("busy_timeout", 5000) / 1000,
+                                   check_same_thread=False)
+            for pragma in ("mmap_size", "cache_size"):
+                if self.settings.get(pragma) is not None:
+                    conn.execute(f"PRAGMA {pragma} = {int(self.settings[pragma])}")
+            self.local.conn = conn
+            with self.connections_lock:
+                self.connections.append(conn)
+        return conn
+
+    def query(self, sql, params, stopped):
+        """Rows of one query on the calling worker thread; raises ReportCancelled
+        once stopped() is true"""
+        if stopped():
+            #cancelled before it started (the progress handler only sees running ones)
+            raise ReportCancelled("Report timed out or was cancelled.")
+        conn = self.connection()
+        #a true result makes SQLite abort the statement ("interrupted")
+        conn.set_progress_handler(stopped, PROGRESS_STEPS)
+        try:
+            return conn.execute(sql, params).fetchall()
+        except sqlite3.OperationalError:
+            if stopped():
+                raise ReportCancelled("Report timed out or was cancelled.") from None
+            raise
+        finally:
+            conn.set_progress_handler(None, 0)
+
+    def run(self, queries, timeout=None, cancel=None):
+        """{name: rows} for queries {name: (sql, params)}, run concurrently
+
+        timeout (seconds, default the engine's) bounds the whole report; cancel
+        is an optional threading.Event the caller can set to stop it early.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout if timeout else None
+        failed = threading.Event()
+
+        def stopped():
+            return (failed.is_set() or (cancel is not None and cancel.is_set())
+                    or (deadline is not None and time.monotonic() > deadline))
+
+        futures = {name: self.pool.submit(self.query, sql, params, stopped)
+                   for name, (sql, params) in queries.items()}
+        results = {}
+        try:
+            for name, future in futures.items():
+                results[name] = future.result()
+        except BaseException:
+            #don't leave the other queries running
+            failed.set()
+            for future in futures.values():
+                future.cancel()
+            raise
+        return results
+
+    def close(self):
+        self.pool.shutdown()
+        with self.connections_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections.clear()
@@ -0,0 +1,236 @@
+import re
+import sqlite3
+from queries import POPULARITY_HISTORY, hot_queries
+
+# Trigram full-text index over products.name/descr. It is an external content
+# table keyed on products.rowid, kept in sync by the triggers below.
+SEARCH_INDEX_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+    name, descr,
+    content='products', content_rowid='rowid',
+    tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+    INSERT INTO products_fts (rowid, name, descr)
+    VALUES (new.rowid, new.name, new.descr);
+END;
+CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+    INSERT INTO products_fts (products_fts, rowid, name, descr)
+    VALUES ('delete', old.rowid, old.name, old.descr);
+END;
+CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF name, descr ON products BEGIN
+    INSERT INTO products_fts (products_fts, rowid, name, descr)
+    VALUES ('delete', old.rowid, old.name, old.descr);
+    INSERT INTO products_fts (rowid, name, descr)
+    VALUES (new.rowid, new.name, new.descr);
+END;
+INSERT INTO products_fts (products_fts) VALUES ('rebuild');
+"""
+
+# Secondary indexes for the hot queries in queries.py
+# (cart lookups by (cid, sessionNo) are already served by its primary key)
+INDEXES_SQL = """
+CREATE INDEX IF NOT EXISTS orders_cid_odate ON orders (cid, odate, ono);
+CREATE INDEX IF NOT EXISTS orders_odate ON orders (odate, cid);
+CREATE INDEX IF NOT EXISTS orderlines_pid ON orderlines (pid, ono);
+CREATE INDEX IF NOT EXISTS viewedProduct_pid ON viewedProduct (pid);
+CREATE INDEX IF NOT EXISTS products_name ON products (name, pid);
+"""
+
+# Per-day sales rollup, maintained by create_order. customers/products are
+# distinct within the day only, so they can't be summed into a window total.
+SALES_DAILY_SQL = """
+CREATE TABLE IF NOT EXISTS sales_daily(
+    day DATE PRIMARY KEY,
+    orders INTEGER NOT NULL DEFAULT 0,
+    revenue REAL NOT NULL DEFAULT 0,
+    customers INTEGER NOT NULL DEFAULT 0,
+    products INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR REPLACE INTO sales_daily (day, orders, revenue, customers, products)
+SELECT o.odate, COUNT(DISTINCT o.ono), COALESCE(SUM(ol.qty * ol.uprice), 0),
+       COUNT(DISTINCT o.cid), COUNT(DISTINCT ol.pid)
+FROM orders o
+LEFT JOIN orderlines ol ON o.ono = ol.ono
+GROUP BY o.odate;
+"""
+
+# Counters for ids that can't come from an INTEGER PRIMARY KEY (users.uid is
+# TEXT), handed out with UPDATE ... RETURNING inside the inserting transaction
+ID_SEQUENCES_SQL = """
+CREATE TABLE IF NOT EXISTS id_sequences(
+    name TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO id_sequences (name, last_id)
+SELECT 'users', COALESCE(MAX(CAST(uid AS INTEGER)), 0) FROM users;
+"""
+
+# View counts of viewedProduct rows moved to the monthly archive databases
+# (archive.py), so leaderboards and reports don't need the archives attached
+ARCHIVE_SUMMARY_SQL = """
+CREATE TABLE IF NOT EXISTS view_counts_archived(
+    pid TEXT NOT NULL,
+    month TEXT NOT NULL,
+    views INTEGER NOT NULL,
+    PRIMARY KEY (pid, month)
+);
+"""
+
+# Per-customer session counter, bumped with UPDATE ... RETURNING when a
+# session starts instead of scanning the customer's sessions for MAX(sessionNo)
+SESSION_COUNTER_SQL = """
+ALTER TABLE customers ADD COLUMN last_session INTEGER NOT NULL DEFAULT 0;
+UPDATE customers
+SET last_session = COALESCE((SELECT MAX(s.sessionNo) FROM sessions s WHERE s.cid = customers.cid), 0);
+"""
+
+# Per-product popularity counters, kept current by triggers so leaderboards and
+# the "popular" search order read one row per product instead of aggregating
+# viewedProduct/orderlines. views is lifetime views: archive.py deletes views it
+# has moved to view_counts_archived, so there is no trigger for viewedProduct
+# deletes. orders counts distinct orders (a repeated pid in one order counts
+# once). ECommerceService.reconcile_popularity rebuilds them from history.
+POPULARITY_SQL = f"""
+CREATE TABLE IF NOT EXISTS product_popularity(
+    pid TEXT PRIMARY KEY,
+    views INTEGER NOT NULL DEFAULT 0,
+    orders INTEGER NOT NULL DEFAULT 0,
+    units INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS product_popularity_views ON product_popularity (views);
+CREATE INDEX IF NOT EXISTS product_popularity_orders ON product_popularity (orders);
+CREATE INDEX IF NOT EXISTS product_popularity_units ON product_popularity (units);
+CREATE TRIGGER IF NOT EXISTS popularity_view AFTER INSERT ON viewedProduct BEGIN
+    INSERT INTO product_popularity (pid, views) VALUES (new.pid, 1)
+    ON CONFLICT (pid) DO UPDATE SET views = views + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS popularity_line_ai AFTER INSERT ON orderlines BEGIN
+    INSERT INTO product_popularity (pid, orders, units)
+    VALUES (new.pid,
+            NOT EXISTS (SELECT 1 FROM orderlines ol WHERE ol.ono = new.ono AND ol.pid = new.pid
+                                                    AND ol.rowid <> new.rowid),
+            new.qty)
+    ON CONFLICT (pid) DO UPDATE SET orders = orders + excluded.orders, units = units + excluded.units;
+END;
+CREATE TRIGGER IF NOT EXISTS popularity_line_ad AFTER DELETE ON orderlines BEGIN
+    UPDATE product_popularity
+    SET orders = orders - NOT EXISTS (SELECT 1 FROM orderlines ol
+                                      WHERE ol.ono = old.ono AND ol.pid = old.pid),
+        units = units - old.qty
+    WHERE pid = old.pid;
+END;
+CREATE TRIGGER IF NOT EXISTS popularity_line_au AFTER UPDATE OF ono, pid, qty ON orderlines BEGIN
+    UPDATE product_popularity
+    SET orders = orders - NOT EXISTS (SELECT 1 FROM orderlines ol
+                                      WHERE ol.ono = old.ono AND ol.pid = old.pid
+                                        AND ol.rowid <> new.rowid),
+        units = units - old.qty
+    WHERE pid = old.pid;
+    INSERT INTO product_popularity (pid, orders, units)
+    VALUES (new.pid,
+            NOT EXISTS (SELECT 1 FROM orderlines ol WHERE ol.ono = new.ono AND ol.pid = new.pid
+                                                    AND ol.rowid <> new.rowid),
+            new.qty)
+    ON CONFLICT (pid) DO UPDATE SET orders = orders + excluded.orders, units = units + excluded.units;
+END;
+INSERT OR REPLACE INTO product_popularity (pid, views, orders, units)
+SELECT pid, views, orders, units FROM ({POPULARITY_HISTORY});
+"""
+
+# Order totals stored on the order (written by checkout) so the order list
+# doesn't sum every order's lines; orders without lines keep a NULL total
+ORDER_TOTALS_SQL = """
+ALTER TABLE orders ADD COLUMN total REAL;
+UPDATE orders
+SET total = (SELECT SUM(ol.qty * ol.uprice) FROM orderlines ol WHERE ol.ono = orders.ono);
+"""
+
+# Schema version n is reached by running MIGRATIONS[n - 1]. Only ever append.
+MIGRATIONS = [
+    SEARCH_INDEX_SQL,
+    INDEXES_SQL,
+    SALES_DAILY_SQL,
+    ID_SEQUENCES_SQL,
+    ARCHIVE_SUMMARY_SQL,
+    SESSION_COUNTER_SQL,
+    POPULARITY_SQL,
+    ORDER_TOTALS_SQL,
+]
+
+
+CLAUSE_KEYWORDS = {"WHERE", "JOIN", "LEFT", "INNER", "CROSS", "ON", "USING",
+                   "GROUP", "ORDER", "LIMIT", "HAVING", "WINDOW", "UNION"}
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def statements(script):
+    """The statements of a script, one at a time (trigger bodies stay whole)"""
+    statement = ""
+    for piece in script.split(";"):
+        statement += piece + ";"
+        if sqlite3.complete_statement(statement):
+            if any(line.strip() and not line.strip().startswith("--")
+                   for line in statement[:-1].splitlines()):
+                yield statement
+            statement = ""
+
+
+def migrate(conn):
+    """Bring the database up to the latest schema version, returns the versions applied"""
+    applied = []
+    for target, script in enumerate(MIGRATIONS, start=1):
+        if schema_version(conn) >= target:
+            continue
+        #each step and its version bump commit together. The version is read
+        #again under the write lock: another process may have just applied it
+        #(executescript would commit before running, so the statements go one by one)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            if schema_version(conn) >= target:
+                conn.rollback()
+                continue
+            for statement in statements(script):
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        applied.append(target)
+    return applied
+
+
+def scanned_tables(sql):
+    """Map of the names a statement's FROM/JOIN clauses use (aliases too) -> table"""
+    names = {}
+    for table, alias in re.findall(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", sql, re.I):
+        names[table] = table
+        if alias and alias.upper() not in CLAUSE_KEYWORDS:
+            names[alias] = table
+    return names
+
+
+def full_scans(conn, sql, params=()):
+    """Tables a statement reads with a full table scan (no index)"""
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    names = scanned_tables(sql)
+    plan = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    scans = []
+    for row in plan:
+        detail = row[-1]
+        if not detail.startswith("SCAN ") or "USING" in detail or "VIRTUAL TABLE" in detail:
+            continue
+        #CTEs, subqueries and constant rows are already materialized
+        if names.get(detail.split()[1]) in tables:
+            scans.append(detail)
+    return scans
+
+
+def check_query_plans(conn, queries=None):
+    """Map of hot query name -> full scans it does (empty when all use indexes)"""
+    queries = queries or hot_queries()
+    return {name: full_scans(conn, sql, params) for name, (sql, params) in queries.items()}
@@ -0,0 +1,438 @@
+"""Line protocol server: many customer and sales sessions in one process
+
+    python server.py prj-test.db --port 8765
+    python server.py prj-test.db --socket /tmp/shop.sock
+
+Each request is one line of JSON with a "cmd" and its arguments, each reply
+one line of JSON: {"ok": true, "result": ...} or {"ok": false, "error": "..."}.
+
+    {"cmd": "login", "uid": "1", "pwd": "password123"}
+    {"cmd": "search", "query": "laptop"}
+    {"cmd": "search", "query": "laptop", "key": ["Laptop Dell XPS 13", "P001"]}
+    {"cmd": "search", "query": "laptop", "sort": "relevance", "key": 10}
+    {"cmd": "add_to_cart", "pid": "P001"}
+    {"cmd": "checkout", "address": "123 Main St"}
+
+Commands follow the CLI menus (see COMMANDS). Database work runs on a
+bounded thread pool; every worker thread has its own connection
+(ECommerceService), and a connection's requests run one at a time, in order.
+Password hashing for login and signup runs on the PasswordHasher's own pool,
+so it never holds a database thread.
+"""
+import argparse
+import asyncio
+import json
+import socket
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from connection import PROFILES, load_profile
+from events import MAX_DELAY
+from passwords import PasswordHasher
+from instrument import Instrumentation
+from reports import ReportEngine
+from service import ECommerceService, ServiceError, ORDER_FIELDS, PAGE_SIZE
+
+
+# order lines per export_orders line
+EXPORT_BATCH = 500
+# most rows a client can ask for in one search or orders page
+MAX_LIMIT = PAGE_SIZE * 20
+
+
+def error_reply(e):
+    """The reply for a request that raised: anything but a ServiceError or a
+    database error is a payload the handler couldn't use (a missing argument,
+    a number where text goes), and only fails that request"""
+    if isinstance(e, ServiceError):
+        return {"ok": False, "error": str(e)}
+    if isinstance(e, sqlite3.Error):
+        return {"ok": False, "error": f"Database error: {e}"}
+    return {"ok": False, "error": f"Bad request: {e!r}"}
+
+
+class Client:
+    """One connected socket: who is logged in on it"""
+    def __init__(self, peer, writer=None, loop=None, cancel=None):
+        self.peer = peer
+        self.session = None
+        self.writer = writer
+        self.loop = loop
+        #set when the server stops, ends the client's running report
+        self.cancel = cancel
+
+    async def send(self, reply):
+        self.writer.write(json.dumps(reply, default=str).encode() + b"\n")
+        await self.writer.drain()
+
+    def send_from_thread(self, reply):
+        """Send a line from a worker thread, waiting until the socket takes it"""
+        asyncio.run_coroutine_threadsafe(self.send(reply), self.loop).result()
+
+
+def page(result):
+    return {"rows": result.rows, "total": result.total}
+
+
+def key(args):
+    """The paging key: a row position for relevance searches, else the
+    keyset tuple (a JSON list)"""
+    if args.get("key") is None:
+        return None
+    if args.get("sort") == "relevance":
+        return int(args["key"])
+    return tuple(args["key"])
+
+
+def limit(args):
+    """The requested page size, capped at MAX_LIMIT"""
+    value = int(args.get("limit", PAGE_SIZE))
+    if value < 1:
+        raise ValueError("limit must be positive")
+    return min(value, MAX_LIMIT)
+
+
+def logout(service, client, args):
+    if client.session is None:
+        raise ServiceError("Not logged in.")
+    session, client.session = client.session, None
+    service.logout(session)
+    return None
+
+
+def search(service, client, args):
+    return page(service.search(client.session, args["query"], key(args),
+                               args.get("forward", True), limit(args), args.get("sort", "name")))
+
+
+def orders(service, client, args):
+    return page(service.orders(client.session, key(args),
+                               args.get("forward", True), limit(args)))
+
+
+def order(service, client, args):
+    header, lines = service.order_detail(client.session, int(args["ono"]))
+    return {"header": header, "lines": lines}
+
+
+def cart(service, client, args):
+    result = service.cart(client.session, args.get("refresh", False))
+    return {"items": result.items, "total": result.total}
+
+
+def export_orders(service, client, args):
+    """Streams the order history, one ORDER_FIELDS dict per order line: a
+    {"ok": true, "rows": [...]} line per EXPORT_BATCH rows, then the reply
+    with the row count ends it"""
+    count = 0
+    batch = []
+    for row in service.export_orders(client.session, EXPORT_BATCH):
+        batch.append(dict(zip(ORDER_FIELDS, row)))
+        if len(batch) == EXPORT_BATCH:
+            client.send_from_thread({"ok": True, "rows": batch})
+            count += len(batch)
+            batch = []
+    if batch:
+        client.send_from_thread({"ok": True, "rows": batch})
+        count += len(batch)
+    return {"count": count}
+
+
+def query_stats(service, client, args):
+    service.require(client.session, 'sales')
+    if service.instrumentation is None:
+        raise ServiceError("Query profiling is off (start the server with --profile-queries).")
+    return service.instrumentation.summary()
+
+
+async def login(server, client, args):
+    """Like service.login, but the password hashing runs on the hasher's pool
+    while the database threads serve other requests"""
+    if client.session is not None:
+        raise ServiceError("Already logged in.")
+    uid, pwd = str(args["uid"]), args["pwd"]
+    row = await server.call("credentials", uid)
+    ok = await asyncio.wrap_future(server.hasher.submit(pwd, row[2] if row else None))
+    if not ok or row is None:
+        raise ServiceError("Invalid user ID or password.")
+    new_hash = (await asyncio.wrap_future(server.hasher.submit_hash(pwd))
+                if server.hasher.needs_rehash(row[2]) else None)
+    session = await server.call("open_session", row, new_hash)
+    client.session = session
+    return {"uid": session.uid, "role": session.role, "session_no": session.session_no}
+
+
+async def signup(server, client, args):
+    pwd_hash = await asyncio.wrap_future(server.hasher.submit_hash(args["pwd"]))
+    return {"uid": await server.call("register", args["name"], args["email"], pwd_hash)}
+
+
+# cmd -> coroutine(server, client, args), run on the event loop; for commands
+# that wait on more than the database
+ASYNC_COMMANDS = {
+    "login": login,
+    "signup": signup,
+}
+
+# cmd -> handler(service, client, args), run on a worker thread
+COMMANDS = {
+    "logout": logout,
+    # customers
+    "search": search,
+    "product": lambda service, client, args: service.product(client.session, args["pid"]),
+    "add_to_cart": lambda service, client, args: service.add_to_cart(client.session, args["pid"]),
+    "cart": cart,
+    "update_cart": lambda service, client, args: service.update_cart_quantity(
+        client.session, args["pid"], int(args["qty"])),
+    "remove_from_cart": lambda service, client, args: service.remove_from_cart(client.session, args["pid"]),
+    "checkout": lambda service, client, args: {"ono": service.checkout(client.session, args["address"])},
+    "orders": orders,
+    "order": order,
+    "export_orders": export_orders,
+    # sales staff
+    "product_info": lambda service, client, args: service.product_info(client.session, args["pid"]),
+    "popularity": lambda service, client, args: service.popularity(client.session, args["pid"]),
+    "update_price": lambda service, client, args: service.update_price(
+        client.session, args["pid"], float(args["price"])),
+    "update_stock": lambda service, client, args: service.update_stock(
+        client.session, args["pid"], int(args["stock"])),
+    "sales_report": lambda service, client, args: service.sales_report(
+        client.session, int(args.get("days", 7)), cancel=client.cancel),
+    "top_products": lambda service, client, args: service.top_products(
+        client.session, args.get("n"), client.cancel),
+    "views_by_month": lambda service, client, args: service.views_by_month(
+        client.session, args["pid"], args.get("include_archive", False)),
+    "search_history": lambda service, client, args: service.search_history(
+        client.session, str(args["cid"]), args.get("include_archive", False)),
+    "query_stats": query_stats,
+}
+
+
+class Server:
+    """Serves the line protocol; database calls go to a pool of `workers`
+    threads, each with its own ECommerceService"""
+    def __init__(self, db_name, workers=8, **service_options):
+        self.db_name = db_name
+        self.workers = workers
+        self.service_options = service_options
+        #one password pool for all connections
+        self.hasher = self.service_options.setdefault("password_hasher", PasswordHasher())
+        self.local = threading.local()
+        self.services = []
+        self.services_lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="db")
+        #cancels running reports once the server stops
+        self.stopping = threading.Event()
+        self.clients = 0
+
+    def service(self):
+        """This worker thread's service, connected on first use"""
+        service = getattr(self.local, "service", None)
+        if service is None:
+            service = ECommerceService(self.db_name, **self.service_options)
+            service.connect()
+            self.local.service = service
+            with self.services_lock:
+                self.services.append(service)
+        return service
+
+    def dispatch(self, client, request):
+        """Run one request on the calling worker thread, returns the reply dict"""
+        try:
+            handler = COMMANDS.get(request.get("cmd"))
+            if handler is None:
+                return {"ok": False, "error": f"Unknown command: {request.get('cmd')}"}
+            return {"ok": True, "result": handler(self.service(), client, request)}
+        except Exception as e:
+            return error_reply(e)
+
+    async def dispatch_async(self, handler, client, request):
+        try:
+            return {"ok": True, "result": await handler(self, client, request)}
+        except Exception as e:
+            return error_reply(e)
+
+    async def run_in_pool(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+
+    async def call(self, method, *args):
+        """A service method run on a worker thread"""
+        return await self.run_in_pool(lambda: getattr(self.service(), method)(*args))
+
+    async def handle(self, reader, writer):
+        client = Client(writer.get_extra_info("peername") or "local", writer,
+                        asyncio.get_running_loop(), self.stopping)
+        self.clients += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("request must be an object")
+                except ValueError as e:
+                    reply = {"ok": False, "error": f"Bad request: {e}"}
+                else:
+                    if request.get("cmd") == "quit":
+                        break
+                    handler = ASYNC_COMMANDS.get(request.get("cmd"))
+                    if handler is not None:
+                        reply = await self.dispatch_async(handler, client, request)
+                    else:
+                        reply = await self.run_in_pool(self.dispatch, client, request)
+                await client.send(reply)
+        except ConnectionError:
+            pass
+        finally:
+            self.clients -= 1
+            if client.session is not None:
+                #write the cart and end the session like a logout
+                await self.run_in_pool(self.dispatch, client, {"cmd": "logout"})
+            writer.close()
+
+    def close(self):
+        """Close every worker's connection on its own thread"""
+        self.stopping.set()
+        if self.services:
+            #one task per pool thread: each waits for the others, so the pool
+            #starts any missing threads and every thread (whichever ones
+            #opened a service) runs exactly one
+            barrier = threading.Barrier(self.workers)
+
+            def close_own():
+                service = getattr(self.local, "service", None)
+                try:
+                    if service is not None:
+                        service.close()
+                finally:
+                    barrier.wait()
+
+            for future in [self.pool.submit(close_own) for _ in range(self.workers)]:
+                future.result()
+        self.pool.shutdown()
+        self.service_options["password_hasher"].close()
+        for shared in ("report_engine", "instrumentation"):
+            if self.service_options.get(shared) is not None:
+                self.service_options[shared].close()
+
+    def flush_stale_events(self):
+        """Write every worker's events older than their max_delay (on a worker
+        thread, with that thread's connection)"""
+        with self.services_lock:
+            services = list(self.services)
+        self.service().flush_stale_events(services)
+
+    async def flush_events_every(self, interval):
+        #a session's events would otherwise wait for its worker's next request
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.run_in_pool(self.flush_stale_events)
+            except sqlite3.Error as e:
+                print(f"Could not write buffered events: {e}")
+
+    async def serve(self, host="127.0.0.1", port=8765, socket_path=None, sock=None):
+        """Listen on host:port, socket_path, or an already listening sock"""
+        if sock is not None and sock.family == socket.AF_UNIX:
+            server = await asyncio.start_unix_server(self.handle, sock=sock)
+        elif sock is not None:
+            server = await asyncio.start_server(self.handle, sock=sock)
+        elif socket_path:
+            server = await asyncio.start_unix_server(self.handle, socket_path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        addresses = ", ".join(str(sock.getsockname()) for sock in server.sockets)
+        print(f"Serving {self.db_name} on {addresses} with {self.workers} database threads")
+        flusher = asyncio.create_task(
+            self.flush_events_every(self.service_options.get("event_delay", MAX_DELAY) / 2))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.stopping.set()
+            flusher.cancel()
+
+
+def add_arguments(parser):
+    """Listening and service options, shared with workers.py"""
+    parser.add_argument("database_file")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", help="listen on a Unix socket instead of TCP")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="concurrent",
+                        help="connection profile (default concurrent: the threads share the file)")
+    parser.add_argument("--config", help="INI file with a [connection] section")
+    parser.add_argument("--top-n", type=int, default=3)
+    parser.add_argument("--search-top-k", type=int, default=100)
+    parser.add_argument("--rank-popularity", type=float, default=0.0)
+    parser.add_argument("--report-workers", type=int, default=2,
+                        help="read-only connections for sales reports (default 2, 0 = run on the worker)")
+    parser.add_argument("--report-timeout", type=float, default=30,
+                        help="give up on a report after this many seconds (default 30)")
+    parser.add_argument("--profile-queries", nargs="?", const="-", metavar="FILE",
+                        help="time every statement (query_stats command), dump histograms on exit")
+    parser.add_argument("--slow-log", metavar="FILE",
+                        help="append statements slower than --slow-ms to FILE with their query plan")
+    parser.add_argument("--slow-ms", type=float, default=100)
+    parser.add_argument("--slow-log-params", action="store_true",
+                        help="write parameter values to the slow log, not just their types")
+    parser.add_argument("--archive-dir", help="where main.py --archive put the archive databases")
+
+
+def load_settings(args):
+    """The connection settings for args, exits on a bad profile or config"""
+    try:
+        return load_profile(args.profile, args.config)
+    except (ValueError, KeyError) as e:
+        print(f"Invalid connection settings: {e}")
+        sys.exit(1)
+
+
+def service_options(args, settings, dump_file=None):
+    """ECommerceService keyword arguments for args (opens the report engine
+    and instrumentation, Server.close() closes them)"""
+    reports = (ReportEngine(args.database_file, args.report_workers, args.report_timeout, settings)
+               if args.report_workers > 0 else None)
+    instrumentation = (Instrumentation(args.slow_ms, args.slow_log, dump_file or args.profile_queries,
+                                       args.slow_log_params)
+                       if args.profile_queries or args.slow_log else None)
+    return dict(top_n=args.top_n, connection_settings=settings, report_engine=reports,
+                instrumentation=instrumentation, search_top_k=args.search_top_k,
+                rank_popularity=args.rank_popularity, archive_dir=args.archive_dir)
+
+
+def migrate(db_name, settings):
+    """Apply migrations once, before any worker connects; exits on error"""
+    setup = ECommerceService(db_name, connection_settings=settings)
+    try:
+        setup.connect()
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+        sys.exit(1)
+    finally:
+        setup.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="E-commerce line protocol server")
+    add_arguments(parser)
+    parser.add_argument("--workers", type=int, default=8, help="database threads (default 8)")
+    args = parser.parse_args()
+    settings = load_settings(args)
+    migrate(args.database_file, settings)
+    server = Server(args.database_file, args.workers, **service_options(args, settings))
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        print("Shutting down.")
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,733 @@
+import sqlite3
+from collections import namedtuple
+from datetime import datetime, timedelta
+import archive
+import catalog
+import schema
+from cache import LeaderboardCache, ProductCache
+from cart import SessionCart
+from passwords import PasswordHasher
+from reports import ReportCancelled
+from events import EVENT_SQL, MAX_DELAY, EventLog, timestamp
+from instrument import InstrumentedConnection
+from connection import load_profile, open_connection, retry_on_busy
+from queries import (CACHE_SIZE, LEADERBOARDS, MIN_INDEXED_KEYWORD, SORTS, QueryRegistry,
+                     direction, like_slots)
+
+PAGE_SIZE = 5
+
+# One page of rows; total is only counted for the first page (no key given)
+Page = namedtuple("Page", "rows total")
+Cart = namedtuple("Cart", "items total")
+# columns of an order history export, one row per order line
+ORDER_FIELDS = ("ono", "odate", "shipping_address", "order_total",
+                "line_no", "pid", "name", "qty", "uprice", "line_total")
+
+
+# the write_<op> methods; write() and the writer process only run these
+WRITES = ("password", "start_session", "end_session", "signup", "cart", "events",
+          "checkout", "product")
+
+
+class ServiceError(Exception):
+    """A request that was refused: bad input, not found, not enough stock..."""
+
+
+class Session:
+    """Who a request is made for: user id, role and (customers) session number,
+    plus the customer's cart once it has been loaded"""
+    def __init__(self, uid, role, session_no=None):
+        self.uid = uid
+        self.role = role
+        self.session_no = session_no
+        self.cart = None
+
+    def __repr__(self):
+        return f"Session({self.uid!r}, {self.role!r}, {self.session_no!r})"
+
+
+def now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class ECommerceService:
+    """The e-commerce operations without any input()/print()
+
+    Every customer or sales operation takes the caller's Session, so one
+    service (one connection) can interleave requests for many users. Methods
+    return plain tuples/lists, raise ServiceError for refused requests and
+    let sqlite3.Error through after rolling back.
+    """
+    def __init__(self, db_name, top_n=3, leaderboard_ttl=0, event_batch=100, event_delay=MAX_DELAY,
+                 connection_settings=None, product_cache_ttl=5, product_cache_size=1000,
+                 cart_flush_every=50, password_hasher=None, report_engine=None,
+                 instrumentation=None, search_top_k=100, search_weights=(10.0, 1.0),
+                 rank_popularity=0.0, writer=None, archive_dir=None):
+        self.db_name = db_name
+        self.connection_settings = connection_settings or load_profile()
+        #searches and product views are buffered and written in batches
+        self.event_batch = event_batch
+        self.event_delay = event_delay
+        self.events = None
+        self.top_n = top_n
+        #leaderboard counts are cached only when a ttl is given
+        self.leaderboard_cache = LeaderboardCache(leaderboard_ttl) if leaderboard_ttl > 0 else None
+        #product rows for detail views and the cart; a ttl of 0 turns it off
+        self.product_cache = (ProductCache(product_cache_ttl, product_cache_size)
+                              if product_cache_ttl > 0 and product_cache_size > 0 else None)
+        #cart changes are written to the cart table once this many are pending
+        self.cart_flush_every = cart_flush_every
+        #shared by services that run in one process (see passwords.py)
+        self.owns_hasher = password_hasher is None
+        self.hasher = password_hasher or PasswordHasher()
+        #sales reports run on these read-only connections when given (see reports.py)
+        self.reports = report_engine
+        #statement timing and slow query log (see instrument.py), shared like the hasher
+        self.instrumentation = instrumentation
+        #relevance search: how many best matches can be paged through, the
+        #weights of name and descr hits, and of units sold (0 = left out)
+        self.search_top_k = search_top_k
+        self.search_weights = search_weights
+        self.rank_popularity = rank_popularity
+        #hands write() operations to a writer process instead (see workers.py)
+        self.writer = writer
+        #where archive_history puts the monthly archives (default next to the database)
+        self.archive_dir = archive_dir
+        #SQL text per statement, sized to the connection's statement cache
+        self.queries = QueryRegistry(CACHE_SIZE)
+        self.conn = None
+        self.cursor = None
+
+    def connect(self):
+        """Open the database and apply pending migrations, returns the versions applied"""
+        if self.instrumentation is None:
+            self.conn = open_connection(self.db_name, self.connection_settings, CACHE_SIZE)
+        else:
+            self.conn = open_connection(self.db_name, self.connection_settings, CACHE_SIZE,
+                                        InstrumentedConnection)
+            self.instrumentation.attach(self.conn)
+        self.queries.attach(self.conn)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute("PRAGMA foreign_keys = ON")
+        self.events = EventLog(self.conn, self.event_batch, self.event_delay, commit=self.commit,
+                               write=None if self.writer is None else self.send_events)
+        return schema.migrate(self.conn)
+
+    def close(self):
+        """Flush buffered events and close the connection"""
+        if self.conn:
+            try:
+                self.events.flush()
+            finally:
+                self.conn.close()
+                self.conn = None
+        if self.owns_hasher:
+            self.hasher.close()
+
+    def commit(self):
+        """Commit, retrying with backoff while another process holds the lock"""
+        retry_on_busy(self.conn.commit, self.connection_settings["busy_retries"])
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def execute(self, name, params=(), shape=()):
+        """Run a statement from the query registry on the service cursor"""
+        return self.queries.run(self.cursor.execute, self.queries.sql(name, shape), params)
+
+    def executemany(self, name, rows):
+        return self.queries.run(self.cursor.executemany, self.queries.sql(name), rows)
+
+    def check_query_plans(self):
+        return schema.check_query_plans(self.conn)
+
+    def rebuild_search_index(self):
+        """Repopulate the search index from products (needed after VACUUM)"""
+        self.execute("rebuild_search_index")
+        self.commit()
+
+    def import_products(self, records, batch_size=catalog.BATCH_SIZE):
+        """Bulk upsert of (line, record) pairs, see catalog.import_products"""
+        try:
+            return catalog.import_products(self.conn, records, batch_size, self.commit)
+        finally:
+            if self.leaderboard_cache is not None:
+                self.leaderboard_cache.invalidate()  # names may have changed
+            if self.product_cache is not None:
+                self.product_cache.invalidate()
+
+    def export_products(self, batch_size=catalog.BATCH_SIZE):
+        """Generator over all product rows, see catalog.export_products"""
+        return catalog.export_products(self.conn, batch_size)
+
+    def require(self, session, role):
+        if session is None or session.role != role:
+            raise ServiceError(f"Only {role} users can do this.")
+
+    # --- accounts and sessions ---
+
+    def hash_password(self, password):
+        """Hash on the hasher's pool (waits for it)"""
+        return self.hasher.submit_hash(password).result()
+
+    def login(self, uid, pwd):
+        """Session for valid credentials (customers get a new shopping session), else None
+
+        Hashes in an older scheme or cost are replaced on a successful login.
+        The server runs the same steps but awaits the hashing between them
+        instead of holding a database thread (see server.login).
+        """
+        row = self.credentials(uid)
+        if not self.hasher.verify(pwd, row[2] if row else None):
+            return None
+        return self.open_session(row, self.hash_password(pwd) if self.hasher.needs_rehash(row[2]) else None)
+
+    def credentials(self, uid):
+        """(uid, role, stored hash) or None"""
+        self.execute("user_credentials", (uid,))
+        return self.cursor.fetchone()
+
+    def open_session(self, row, new_hash=None):
+        """Session for a verified credentials row, storing new_hash if given"""
+        if new_hash is not None:
+            try:
+                self.write("password", row[0], new_hash)
+            except sqlite3.Error:
+                pass  # keep the old hash, it still works
+        session = Session(row[0], row[1])
+        if session.role == 'customer':
+            session.session_no = self.start_session(session.uid)
+        return session
+
+    def logout(self, session):
+        """Write the session's cart and this process's events, and record the
+        end of a customer's session"""
+        if session.cart is not None:
+            self.flush_cart(session)
+        self.events.flush()
+        if session.role == 'customer' and session.session_no:
+            self.write("end_session", session.uid, session.session_no, now())
+
+    def start_session(self, cid):
+        """Open a new session for a customer, returns its number"""
+        return self.write("start_session", cid, now())
+
+    def signup(self, name, email, pwd):
+        """Register a customer, returns the new user id"""
+        return self.register(name, email, self.hash_password(pwd))
+
+    def register(self, name, email, pwd_hash):
+        """signup() with the password already hashed"""
+        return self.write("signup", name, email, pwd_hash)
+
+    def next_id(self, name):
+        """Allocate the next id from id_sequences (part of the caller's transaction)"""
+        self.execute("next_id", (name,))
+        return self.cursor.fetchone()[0]
+
+    # --- writes ---
+    # Every change customers and sales staff make is one write_<op> method. They
+    # run their statements without committing: write() gives each one its own
+    # transaction, or sends it to the writer process, which runs many of them
+    # in one transaction (workers.py). Arguments and results are plain values.
+
+    def write(self, op, *args):
+        """Run write_<op>(*args) in its own transaction, returns its result
+
+        The whole transaction (BEGIN IMMEDIATE, the statements, COMMIT) is
+        rolled back and retried with backoff while another process holds the
+        lock, not just the commit.
+        """
+        if op not in WRITES:
+            raise ValueError(f"Unknown write: {op}")
+        if self.writer is not None:
+            return self.writer.call(op, args)
+        write = getattr(self, f"write_{op}")
+
+        def transaction():
+            try:
+                #take the write lock up front so busy_timeout applies to it
+                if not self.conn.in_transaction:
+                    self.conn.execute("BEGIN IMMEDIATE")
+                result = write(*args)
+                self.conn.commit()
+                return result
+            except Exception:
+                if self.conn.in_transaction:
+                    self.rollback()
+                raise
+        return retry_on_busy(transaction, self.connection_settings["busy_retries"])
+
+    def flush_stale_events(self, services):
+        """Write the events other services (on other threads) have buffered for
+        longer than their max_delay, on this service's connection"""
+        for service in services:
+            events = service.events
+            batches = events.take_stale() if events is not None else {}
+            if batches:
+                try:
+                    self.write("events", batches)
+                except sqlite3.Error:
+                    events.put_back(batches)
+                    raise
+
+    def send_events(self, batches):
+        """EventLog flushes go to the writer process like any other write"""
+        self.write("events", batches)
+
+    def write_password(self, uid, pwd_hash):
+        self.execute("update_password", (pwd_hash, uid))
+
+    def write_start_session(self, cid, start_time):
+        #the counter update takes the write lock, so concurrent logins get distinct numbers
+        self.execute("next_session_no", (cid,))
+        row = self.cursor.fetchone()
+        if not row:
+            raise ServiceError("Customer not found.")
+        self.execute("insert_session", (cid, row[0], start_time))
+        return row[0]
+
+    def write_end_session(self, cid, session_no, end_time):
+        self.execute("end_session", (end_time, cid, session_no))
+
+    def write_signup(self, name, email, pwd_hash):
+        self.execute("email_in_use", (email,))
+        if self.cursor.fetchone():
+            raise ServiceError("Email already in use!")
+        #unique user ID
+        new_uid = str(self.next_id("users"))
+        self.execute("insert_user", (new_uid, pwd_hash))
+        self.execute("insert_customer", (new_uid, name, email))
+        return new_uid
+
+    def write_cart(self, cid, session_no, upserts, deletes):
+        self.executemany("upsert_cart_item", [(cid, session_no, pid, qty) for pid, qty in upserts])
+        self.executemany("delete_cart_item", [(cid, session_no, pid) for pid in deletes])
+
+    def write_events(self, batches):
+        """batches: {table: rows} from an EventLog"""
+        for table, rows in batches.items():
+            self.conn.executemany(EVENT_SQL[table], rows)
+
+    def write_checkout(self, cid, session_no, odate, shipping_address):
+        """Turn the cart table's rows into an order, returns (ono, [(pid, name)])
+
+        A fixed number of statements however big the cart is.
+        """
+        # Insert order, ono is the rowid so SQLite numbers it under the write lock
+        self.execute("insert_order", (cid, session_no, odate, shipping_address))
+        ono = self.cursor.lastrowid
+        #All lines straight from the cart, priced as of now
+        self.execute("insert_orderlines", (ono, cid, session_no))
+        line_count = self.cursor.rowcount
+        if line_count == 0:
+            raise ServiceError("Your cart is empty.")
+        self.execute("set_order_total", (ono,))
+        #Update stock in one statement, lines short on stock are skipped
+        self.execute("take_stock", (cid, session_no))
+        if self.cursor.rowcount != line_count:
+            raise ServiceError(
+                "Order cancelled - not enough stock left for some items. Please review your cart.")
+        #Fold the order into the sales_daily rollup
+        self.execute("record_daily_sales", (ono,))
+        self.execute("ordered_products", (ono,))
+        ordered = self.cursor.fetchall()
+        #Clear cart
+        self.execute("clear_cart", (cid, session_no))
+        return ono, ordered
+
+    def write_product(self, pid, statement, value):
+        self.execute(statement, (value, pid))
+        if self.cursor.rowcount == 0:
+            raise ServiceError("Product not found.")
+
+    # --- customers ---
+
+    def search(self, session, query, key=None, forward=True, limit=PAGE_SIZE, sort="name"):
+        """One page of products matching every keyword, ordered by (name, pid)
+
+        Rows are (pid, name, category, price, stock_count). Pass the last
+        row's (name, pid) as key for the next page, or the first row's with
+        forward=False for the previous one. The first page also records the
+        search and counts the matches. sort="popular" orders by units sold,
+        highest first; rows then end with units sold and the key is
+        (units sold, pid). sort="relevance" pages through the best
+        search_top_k matches only (see ranked_search).
+        """
+        self.require(session, 'customer')
+        keywords = query.lower().split()
+        if not keywords:
+            raise ServiceError("Please enter at least one keyword.")
+        if sort not in SORTS:
+            raise ServiceError(f"Unknown sort order: {sort}")
+        if key is None:
+            self.events.log("search", (session.uid, session.session_no, timestamp(), query))
+        #keywords long enough for the trigram index become one AND-ed MATCH,
+        #the rest are padded to a fixed number of LIKE slots (see queries.py)
+        indexed = [k for k in keywords if len(k) >= MIN_INDEXED_KEYWORD]
+        short = [k for k in keywords if len(k) < MIN_INDEXED_KEYWORD]
+        likes = like_slots(len(short))
+        params = []
+        if indexed:
+            params.append(" AND ".join('"' + k.replace('"', '""') + '"' for k in indexed))
+        for keyword in short:
+            params.extend([f"%{keyword}%", f"%{keyword}%"])
+        params.extend(["%", "%"] * (likes - len(short)))
+
+        total = None
+        if key is None:
+            self.execute("search", params, (True, bool(indexed), likes, "first"))
+            total = self.cursor.fetchone()[0]
+        if sort == "relevance":
+            return self.ranked_search(bool(indexed), likes, params, total, key, forward, limit)
+        self.execute("search", params + list(key or ()) + [limit],
+                     (False, bool(indexed), likes, direction(key, forward), sort))
+        rows = self.cursor.fetchall()
+        return Page(rows if forward else rows[::-1], total)
+
+    def ranked_search(self, indexed, likes, params, total, key, forward, limit):
+        """Page of the best matches, rows ending with their 1-based position
+
+        Scores combine bm25 over name/descr for indexed keywords, name/descr
+        LIKE hits for short ones (search_weights) and optionally units sold
+        (rank_popularity).
+        Only the top search_top_k are reachable, so each page costs one bounded
+        top-k sort; the key is the position of the last row (or, going back,
+        of the first row).
+        """
+        name_weight, descr_weight = self.search_weights
+        top_k = self.search_top_k
+        if key is None:
+            offset = 0
+        elif forward:
+            offset = key
+        else:
+            offset = max(0, key - 1 - limit)
+            limit = key - 1 - offset
+        limit = max(0, min(limit, top_k - offset))
+        #params are the MATCH (if indexed) then (name, descr) LIKE patterns per slot
+        patterns = params[1:] if indexed else params
+        scores = [name_weight, descr_weight] if indexed else []
+        for name_pattern, descr_pattern in zip(patterns[::2], patterns[1::2]):
+            scores += [name_pattern, name_weight, descr_pattern, descr_weight]
+        if self.rank_popularity:
+            scores.append(self.rank_popularity)
+        self.execute("ranked_search", scores + params + [limit, offset],
+                     (indexed, likes, bool(self.rank_popularity)))
+        rows = [row[:5] + (offset + i + 1,) for i, row in enumerate(self.cursor.fetchall())]
+        return Page(rows, None if total is None else min(total, top_k))
+
+    def product(self, session, pid):
+        """Full product row (pid, name, category, price, stock_count, descr), recorded as a view"""
+        self.require(session, 'customer')
+        details = self.product_row(pid)
+        if not details:
+            raise ServiceError("Product not found.")
+        self.events.log("viewedProduct", (session.uid, session.session_no, timestamp(), pid))
+        if self.leaderboard_cache is not None:
+            self.leaderboard_cache.increment("views", pid, details[1])
+        return details
+
+    def product_row(self, pid):
+        """Product row through the product cache, None if there is no such product"""
+        if self.product_cache is not None:
+            row = self.product_cache.get(pid)
+            if row is not None:
+                return row
+        self.execute("product", (pid,))
+        row = self.cursor.fetchone()
+        if row and self.product_cache is not None:
+            self.product_cache.put(pid, row)
+        return row
+
+    def session_cart(self, session, refresh=False):
+        """The session's in-memory cart, loaded from the cart table (with
+        current prices and stock) the first time or when refresh is set"""
+        if session.cart is None or refresh:
+            if session.cart is not None:
+                self.flush_cart(session)
+            self.execute("cart_lines", (session.uid, session.session_no))
+            session.cart = SessionCart(self.cursor.fetchall())
+        return session.cart
+
+    def flush_cart(self, session):
+        """Write the cart's pending changes to the cart table"""
+        cart = session.cart
+        if not cart.pending:
+            return
+        upserts, deletes = cart.pending_writes()
+        self.write("cart", session.uid, session.session_no, upserts, deletes)
+        cart.pending.clear()
+
+    def cart_changed(self, session):
+        if len(session.cart.pending) >= self.cart_flush_every:
+            self.flush_cart(session)
+
+    def add_to_cart(self, session, pid, available_stock=None):
+        """Add one unit of a product to the cart, returns the new quantity
+
+        The stock check may use a cached row; checkout checks stock again.
+        """
+        self.require(session, 'customer')
+        cart = self.session_cart(session)
+        product = None
+        if available_stock is None or pid not in cart:
+            product = self.product_row(pid)
+            if not product:
+                raise ServiceError("Product not found.")
+            if available_stock is None:
+                available_stock = product[4]
+        new_qty = cart.qty(pid) + 1
+        if new_qty > available_stock:
+            raise ServiceError("Cannot add more - insufficient stock!")
+        cart.set(pid, new_qty, product)
+        self.cart_changed(session)
+        return new_qty
+
+    def cart(self, session, refresh=False):
+        """Cart items (pid, name, price, qty, stock_count, total) and the grand total
+
+        Served from the session's cart; refresh=True re-reads prices and stock
+        (checkout does this before showing the order summary).
+        """
+        self.require(session, 'customer')
+        cart = self.session_cart(session, refresh)
+        return Cart(cart.items(), cart.total)
+
+    def update_cart_quantity(self, session, pid, new_qty):
+        self.require(session, 'customer')
+        if new_qty <= 0:
+            raise ServiceError("Quantity must be positive.")
+        cart = self.session_cart(session)
+        if pid not in cart:
+            raise ServiceError("Product not in cart.")
+        if new_qty > cart.stock(pid):
+            raise ServiceError("Insufficient stock!")
+        cart.set(pid, new_qty)
+        self.cart_changed(session)
+
+    def remove_from_cart(self, session, pid):
+        self.require(session, 'customer')
+        cart = self.session_cart(session)
+        if pid not in cart:
+            raise ServiceError("Product not in cart.")
+        cart.remove(pid)
+        self.cart_changed(session)
+
+    def checkout(self, session, shipping_address):
+        """Turn the cart into an order, returns the order number
+
+        A fixed number of statements however big the cart is.
+        """
+        self.require(session, 'customer')
+        if not shipping_address:
+            raise ServiceError("Shipping address is required.")
+        #the order is built from the cart table, so write pending changes first
+        self.session_cart(session)
+        self.flush_cart(session)
+        try:
+            ono, ordered = self.write("checkout", session.uid, session.session_no,
+                                      datetime.now().strftime("%Y-%m-%d"), shipping_address)
+        except (sqlite3.Error, ServiceError):
+            if self.product_cache is not None:
+                #the cart may have been priced/checked against stale rows
+                for pid in session.cart.lines:
+                    self.product_cache.invalidate(pid)
+            session.cart = None  # reloaded with current stock next time
+            raise
+        session.cart = SessionCart()
+        for pid, name in ordered:
+            if self.product_cache is not None:
+                self.product_cache.invalidate(pid)  # stock went down
+            if self.leaderboard_cache is not None:
+                self.leaderboard_cache.increment("orders", pid, name)
+        return ono
+
+    def orders(self, session, key=None, forward=True, limit=PAGE_SIZE):
+        """One page of the customer's orders (ono, odate, address, total), newest first
+
+        Paged like search() on (odate, ono).
+        """
+        self.require(session, 'customer')
+        total = None
+        if key is None:
+            self.execute("orders_count", (session.uid,))
+            total = self.cursor.fetchone()[0]
+        self.execute("orders_page", [session.uid] + list(key or ()) + [limit],
+                     (direction(key, forward),))
+        rows = self.cursor.fetchall()
+        return Page(rows if forward else rows[::-1], total)
+
+    def order_detail(self, session, ono):
+        """Order header (ono, odate, address, total) and lines (name, category,
+        qty, uprice, line_total), from one query"""
+        self.require(session, 'customer')
+        self.execute("order_detail", (ono, session.uid))
+        rows = self.cursor.fetchall()
+        if not rows:
+            raise ServiceError("Order not found.")
+        return rows[0][:4], [row[4:] for row in rows if row[4] is not None]
+
+    def export_orders(self, session, batch_size=catalog.BATCH_SIZE):
+        """Generator over the customer's whole order history, one ORDER_FIELDS
+        row per order line, batch_size rows in memory at a time"""
+        self.require(session, 'customer')
+        #its own cursor, so other calls can run while the export is read
+        cursor = self.queries.run(self.conn.execute, self.queries.sql("order_history"), (session.uid,))
+        return catalog.stream_rows(cursor, batch_size)
+
+    # --- sales staff ---
+
+    def product_info(self, session, pid):
+        """Product row for sales staff (not recorded as a view)"""
+        self.require(session, 'sales')
+        self.execute("product", (pid,))
+        product = self.cursor.fetchone()
+        if not product:
+            raise ServiceError("Product not found.")
+        return product
+
+    def popularity(self, session, pid):
+        """(views, orders, units sold) of a product from its counters"""
+        self.require(session, 'sales')
+        self.events.flush()
+        self.execute("popularity", (pid,))
+        return self.cursor.fetchone() or (0, 0, 0)
+
+    def reconcile_popularity(self):
+        """Rebuild product_popularity from history, returns how many products
+        had drifted"""
+        self.events.flush()
+        try:
+            self.execute("popularity_drift")
+            drifted = self.cursor.fetchone()[0]
+            if drifted:
+                self.execute("clear_popularity")
+                self.execute("rebuild_popularity")
+            self.commit()
+        except sqlite3.Error:
+            self.rollback()
+            raise
+        if self.leaderboard_cache is not None:
+            self.leaderboard_cache.invalidate()
+        return drifted
+
+    def update_price(self, session, pid, new_price):
+        self.require(session, 'sales')
+        if new_price <= 0:
+            raise ServiceError("Price must be positive.")
+        self.update_product(pid, "update_price", new_price)
+
+    def update_stock(self, session, pid, new_stock):
+        self.require(session, 'sales')
+        if new_stock < 0:
+            raise ServiceError("Stock must be non-negative.")
+        self.update_product(pid, "update_stock", new_stock)
+
+    def update_product(self, pid, statement, value):
+        try:
+            self.write("product", pid, statement, value)
+        finally:
+            if self.product_cache is not None:
+                self.product_cache.invalidate(pid)
+
+    def sales_report(self, session, days=7, exact=True, cancel=None):
+        """Sales figures for the last `days` days as a dict
+
+        Orders and revenue are summed from the sales_daily rollup. Distinct
+        customers/products over the window need one pass over the window's
+        orders (exact); otherwise the per-day counts are summed, which counts
+        a customer again for every day they ordered on. Setting cancel (see
+        report) stops it.
+        """
+        self.require(session, 'sales')
+        today = datetime.now()
+        start = (today - timedelta(days=days)).strftime("%Y-%m-%d")
+        end = today.strftime("%Y-%m-%d")
+        names = ["sales_rollup", "sales_distinct"] if exact else ["sales_rollup"]
+        results = self.report({name: (name, (start, end)) for name in names}, cancel)
+        num_orders, total_sales, num_customers, num_products = results["sales_rollup"][0]
+        if exact:
+            num_customers, num_products = results["sales_distinct"][0]
+        return {
+            "days": days,
+            "orders": num_orders,
+            "products": num_products,
+            "customers": num_customers,
+            "total_sales": total_sales,
+            "avg_per_customer": total_sales / num_customers if num_customers > 0 else 0,
+        }
+
+    def views_by_month(self, session, pid, include_archive=False):
+        """[(month "YYYY-MM", views)] for a product, newest first; archived
+        months come from the view_counts_archived summary"""
+        self.require(session, 'sales')
+        self.events.flush()
+        counts = {}
+        self.execute("views_by_month", (pid,))
+        for month, views in self.cursor.fetchall():
+            counts[month] = views
+        if include_archive:
+            self.execute("archived_views_by_month", (pid,))
+            for month, views in self.cursor.fetchall():
+                counts[month] = counts.get(month, 0) + views
+        return sorted(counts.items(), reverse=True)
+
+    def search_history(self, session, cid, include_archive=False):
+        """[(session no, ts, query)] a customer searched for, oldest first;
+        include_archive adds the searches moved to the monthly archives"""
+        self.require(session, 'sales')
+        self.events.flush()
+        rows = []
+        if include_archive:
+            #ATTACH needs no open transaction, which reads here don't leave behind
+            rows = sorted((row[1:] for row in archive.archived_rows(
+                self.conn, self.db_name, "search", self.archive_dir, condition="cid = ?", params=(cid,))),
+                key=lambda row: row[1])
+        self.execute("search_history", (cid,))
+        return rows + self.cursor.fetchall()
+
+    def archive_history(self, retention_days=90, archive_dir=None):
+        """Move old views, searches and sessions to the monthly archives, see archive.archive"""
+        self.events.flush()
+        moved = archive.archive(self.conn, self.db_name, retention_days,
+                                archive_dir or self.archive_dir, self.commit)
+        if self.leaderboard_cache is not None:
+            self.leaderboard_cache.invalidate("views")
+        return moved
+
+    def top_products(self, session, n=None, cancel=None):
+        """{"orders": rows, "views": rows} of (pid, name, count), top n with ties
+
+        Boards not in the leaderboard cache are queried together (see report).
+        """
+        self.require(session, 'sales')
+        n = n or self.top_n
+        #include this process's buffered views
+        self.events.flush()
+        if self.leaderboard_cache is None:
+            return self.report({kind: (f"top_{kind}", (n,)) for kind in LEADERBOARDS}, cancel)
+        boards = {kind: self.leaderboard_cache.top(kind, n) for kind in LEADERBOARDS}
+        missing = [kind for kind, rows in boards.items() if rows is None]
+        for kind, rows in self.report({kind: (f"{kind}_counts", ()) for kind in missing}, cancel).items():
+            self.leaderboard_cache.put(kind, rows)
+            boards[kind] = self.leaderboard_cache.top(kind, n)
+        return boards
+
+    def report(self, queries, cancel=None):
+        """{name: rows} for {name: (statement, params)}: side by side on the report
+        engine's read-only connections if there is one, else one after another here.
+        cancel is an optional threading.Event that stops the engine's queries
+        (ServiceError) when set"""
+        if self.reports is None:
+            results = {}
+            for name, (statement, params) in queries.items():
+                self.execute(statement, params)
+                results[name] = self.cursor.fetchall()
+            return results
+        try:
+            return self.reports.run({name: (self.queries.sql(statement), params)
+                                     for name, (statement, params) in queries.items()},
+                                    cancel=cancel)
+        except ReportCancelled as e:
+            raise ServiceError(str(e))
@@ -0,0 +1,375 @@
+"""Multi-process deployment: several server processes share one database file
+
+    python workers.py prj-test.db --processes 4 --port 8765
+    python workers.py prj-test.db --processes 4 --socket /tmp/shop.sock
+
+The supervisor opens the listening socket, applies migrations and starts
+--processes worker processes and one writer process. Each worker is a
+server.Server (same line protocol, --threads database threads) accepting
+connections from the shared socket; it reads and keeps sessions on its own
+connections, but every change (logins and logouts, signups, cart writes,
+checkouts, price and stock updates, buffered search/view events) is sent to
+the writer as one ECommerceService.write() operation.
+
+The writer is the only process that writes. It takes whatever operations are
+waiting (up to --batch-size, waiting --batch-wait-ms for more), runs each in
+its own savepoint so a failed one doesn't undo the others, commits them all
+at once and only then replies. Under load one commit covers many writes, and
+workers never wait on each other's write locks.
+
+Workers reach the writer over a private Unix socket, each on its own
+connection, so a process that dies takes nothing shared with it: the
+supervisor restarts it, and a restarted writer is reconnected to on the next
+write (writes it hadn't answered fail). SIGINT/SIGTERM stops the workers
+first (they log their clients out through the writer), then the writer.
+"""
+import argparse
+import asyncio
+import itertools
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import AuthenticationError, Client, Listener, wait
+import server
+from connection import retry_on_busy
+from service import ECommerceService, ServiceError, WRITES
+
+# seconds a worker waits for the writer before giving up on a write
+WRITE_TIMEOUT = 30
+# seconds between a process exiting and its restart
+RESTART_DELAY = 1.0
+
+
+def error(name, message):
+    """The exception a worker raises for an error the writer replied with"""
+    if name == "ServiceError":
+        return ServiceError(message)
+    cls = getattr(sqlite3, name, None)
+    if isinstance(cls, type) and issubclass(cls, sqlite3.Error):
+        return cls(message)
+    return sqlite3.Error(f"{name}: {message}")
+
+
+def run_batch(service, batch):
+    """Run [(conn, request id, op, args)] in one transaction, each op in its
+    own savepoint; returns [(conn, reply)] once committed"""
+    db = service.conn
+    replies = []
+    try:
+        retry_on_busy(lambda: db.execute("BEGIN IMMEDIATE"), service.connection_settings["busy_retries"])
+        for conn, request_id, op, args in batch:
+            db.execute("SAVEPOINT op")
+            try:
+                if op not in WRITES:
+                    raise ValueError(f"Unknown write: {op}")
+                replies.append((conn, (request_id, True, getattr(service, f"write_{op}")(*args))))
+            except Exception as e:
+                db.execute("ROLLBACK TO op")
+                replies.append((conn, (request_id, False, (type(e).__name__, str(e)))))
+            db.execute("RELEASE op")
+        service.commit()
+    except sqlite3.Error as e:
+        #nothing in the batch was written
+        if db.in_transaction:
+            service.rollback()
+        return [(conn, (request_id, False, (type(e).__name__, str(e))))
+                for conn, request_id, _, _ in batch]
+    return replies
+
+
+def receive(conn, requests):
+    """Queue one worker's requests as (conn, request id, op, args)"""
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            conn.close()
+            return
+        requests.put(None if message is None else (conn,) + message)
+
+
+def accept(listener, requests):
+    while True:
+        try:
+            conn = listener.accept()
+        except AuthenticationError:
+            continue
+        except OSError:
+            return
+        threading.Thread(target=receive, args=(conn, requests), name="writer-receive", daemon=True).start()
+
+
+def writer_main(address, authkey, db_name, settings, batch_size, batch_wait):
+    """The writer process: group-commits requests until it gets None (or the
+    supervisor is gone)"""
+    #the supervisor stops it (with None) once the workers are done, even when
+    #the signal went to the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    supervisor = multiprocessing.parent_process()
+    service = ECommerceService(db_name, connection_settings=settings)
+    service.connect()
+    if os.path.exists(address):
+        os.unlink(address)  # left by a writer that was killed
+    listener = Listener(address, "AF_UNIX", authkey=authkey)
+    requests = queue.Queue()
+    threading.Thread(target=accept, args=(listener, requests), name="writer-accept", daemon=True).start()
+    writes = batches = 0
+    try:
+        stop = False
+        while not stop:
+            try:
+                request = requests.get(timeout=1)
+            except queue.Empty:
+                if supervisor.is_alive():
+                    continue
+                break
+            if request is None:
+                break
+            batch = [request]
+            deadline = time.monotonic() + batch_wait
+            while len(batch) < batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    request = requests.get(timeout=remaining) if remaining > 0 else requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+            for conn, reply in run_batch(service, batch):
+                try:
+                    conn.send(reply)
+                except OSError:
+                    pass  # the worker is gone
+            writes += len(batch)
+            batches += 1
+    finally:
+        listener.close()
+        service.close()
+        print(f"Writer: {writes} writes in {batches} transactions")
+
+
+class WriterClient:
+    """A worker process's connection to the writer; ECommerceService.write()
+    calls call() from any of the worker's threads"""
+    def __init__(self, address, authkey, timeout=WRITE_TIMEOUT):
+        self.address = address
+        self.authkey = authkey
+        self.timeout = timeout
+        self.conn = None
+        self.pending = None  # request id -> Future, for the current connection
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """Connect (holding the lock), waiting for the writer to start"""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                conn = Client(self.address, "AF_UNIX", authkey=self.authkey)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise sqlite3.OperationalError("The writer process is not running.") from None
+                time.sleep(0.1)
+        self.conn, self.pending = conn, {}
+        threading.Thread(target=self.read_replies, args=(conn, self.pending),
+                         name="writer-replies", daemon=True).start()
+
+    def read_replies(self, conn, pending):
+        while True:
+            try:
+                request_id, ok, value = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                future = pending.pop(request_id, None)
+            if future is None:
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(error(*value))
+        #the writer stopped: fail what it didn't answer, the next call reconnects
+        with self.lock:
+            if self.conn is conn:
+                self.conn = None
+            lost = list(pending.values())
+            pending.clear()
+        conn.close()
+        for future in lost:
+            future.set_exception(sqlite3.OperationalError("The writer process stopped before answering."))
+
+    def call(self, op, args):
+        """Run write_<op>(*args) in the writer process, returns its result"""
+        future = Future()
+        with self.lock:
+            if self.conn is None:
+                self.connect()
+            request_id = next(self.ids)
+            pending = self.pending
+            pending[request_id] = future
+            try:
+                self.conn.send((request_id, op, args))
+            except OSError:
+                pending.pop(request_id, None)
+                raise sqlite3.OperationalError("The writer process is not running.") from None
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            with self.lock:
+                pending.pop(request_id, None)
+            raise sqlite3.OperationalError("The writer process did not answer in time.") from None
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+def interrupt(signum, frame):
+    """Stop on the first SIGINT/SIGTERM and ignore the rest, so a second
+    signal can't cut the worker's logouts short"""
+    signal.signal(signal.SIGINT, ignore)
+    signal.signal(signal.SIGTERM, ignore)
+    raise KeyboardInterrupt
+
+
+def ignore(signum, frame):
+    pass
+
+
+def worker_main(number, args, sock, address, authkey):
+    """A worker process: a Server on the shared socket, writing through the writer"""
+    signal.signal(signal.SIGINT, interrupt)
+    signal.signal(signal.SIGTERM, interrupt)
+    settings = server.load_settings(args)
+    writer = WriterClient(address, authkey)
+    #one dump file per process
+    dump_file = f"{args.profile_queries}.{number}" if args.profile_queries not in (None, "-") else None
+    app = server.Server(args.database_file, args.threads, writer=writer,
+                        **server.service_options(args, settings, dump_file))
+    try:
+        asyncio.run(app.serve(sock=sock))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        app.close()
+        writer.close()
+
+
+def listen(args):
+    """The listening socket the workers share"""
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(args.socket)
+        sock.listen(128)
+        return sock
+    return socket.create_server((args.host, args.port), backlog=128)
+
+
+class Supervisor:
+    """Starts the writer and worker processes and restarts any that exit"""
+    def __init__(self, args, settings, sock):
+        self.args = args
+        self.settings = settings
+        self.sock = sock
+        #the writer's socket, in a directory only this user can open
+        self.directory = tempfile.mkdtemp(prefix="shop-writer-")
+        self.address = os.path.join(self.directory, "writer.sock")
+        self.authkey = os.urandom(32)
+        self.writer = None
+        self.workers = [None] * args.processes
+
+    def start_writer(self):
+        self.writer = multiprocessing.Process(
+            target=writer_main, name="writer",
+            args=(self.address, self.authkey, self.args.database_file, self.settings,
+                  self.args.batch_size, self.args.batch_wait_ms / 1000))
+        self.writer.start()
+
+    def start_worker(self, number):
+        self.workers[number] = multiprocessing.Process(
+            target=worker_main, name=f"worker-{number}",
+            args=(number, self.args, self.sock, self.address, self.authkey))
+        self.workers[number].start()
+
+    def run(self):
+        self.start_writer()
+        for number in range(len(self.workers)):
+            self.start_worker(number)
+        print(f"Supervising {len(self.workers)} workers and a writer (pid {os.getpid()})")
+        while True:
+            processes = {process.sentinel: process for process in [self.writer] + self.workers}
+            for sentinel in wait(list(processes)):
+                process = processes[sentinel]
+                process.join()
+                print(f"{process.name} exited with code {process.exitcode}, restarting")
+                time.sleep(RESTART_DELAY)
+                if process is self.writer:
+                    self.start_writer()
+                else:
+                    self.start_worker(self.workers.index(process))
+
+    def stop(self):
+        for process in self.workers:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+        for process in self.workers:
+            if process is not None:
+                process.join()
+        #the workers waited for their last writes, so nothing is left to answer
+        if self.writer is not None and self.writer.is_alive():
+            try:
+                with Client(self.address, "AF_UNIX", authkey=self.authkey) as conn:
+                    conn.send(None)
+            except OSError:
+                self.writer.terminate()
+            self.writer.join()
+        self.sock.close()
+        if self.args.socket and os.path.exists(self.args.socket):
+            os.unlink(self.args.socket)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="E-commerce server: worker processes and one writer")
+    server.add_arguments(parser)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1,
+                        help="worker processes (default one per CPU)")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="database threads in each worker (default 4)")
+    parser.add_argument("--batch-size", type=int, default=64,
+                        help="most writes committed in one transaction (default 64)")
+    parser.add_argument("--batch-wait-ms", type=float, default=0,
+                        help="wait this long for more writes before committing (default 0: "
+                             "only what queued up during the last commit)")
+    args = parser.parse_args()
+    settings = server.load_settings(args)
+    server.migrate(args.database_file, settings)
+    supervisor = Supervisor(args, settings, listen(args))
+    signal.signal(signal.SIGINT, interrupt)
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        print("Shutting down.")
+    finally:
+        supervisor.stop()
+
+
+if __name__ == "__main__":
+    main()